@@ -0,0 +1,167 @@
+'''
+Local stand-in for TelegramClient serving made up chats, for benchmarks
+that have to run without a network or an account.
+
+Messages are real telethon Message objects, generated from the chat and
+message id so every run and every get_messages sees the same content.
+Each request sleeps for `latency` seconds, download chunks also for their
+size over `bandwidth`, and fails with a flood wait with `flood_rate`
+probability. Requests go through the same RateLimiter as RateLimitedClient,
+so flood waits pause and shrink pages the way they do against Telegram.
+'''
+import struct
+import random
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from telethon.utils import resolve_id
+from telethon.tl.types import (
+    Message, PeerChannel, PeerUser,
+    MessageMediaPhoto, MessageMediaDocument, Photo, PhotoSize, Document, DocumentAttributeFilename,
+)
+
+from tgsync.core.rate_limit import RateLimiter
+
+
+WORDS = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', '你好', 'привет')
+EPOCH = datetime(2020, 1, 1, tzinfo=timezone.utc)
+HISTORY_PAGE = 100
+
+
+class FakeClient:
+    def __init__(self, chats, latency=0.05, bandwidth=0, chunk_size=512*1024,
+                 photo_ratio=0.2, document_ratio=0.1, photo_size=200*1024, document_size=4*1024**2,
+                 flood_rate=0, flood_seconds=1, seed=0):
+        '''
+        chats maps the id of each chat to its number of messages,
+        bandwidth is in bytes per second, 0 for unlimited.
+        '''
+        self.chats = chats
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.chunk_size = chunk_size
+        self.photo_ratio = photo_ratio
+        self.document_ratio = document_ratio
+        self.photo_size = photo_size
+        self.document_size = document_size
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.rng = random.Random(seed)
+        self.seed = seed
+        self.limiter = RateLimiter()
+        self.requests = 0
+        self.flood_waits = 0
+        self.block = random.Random(seed).randbytes(chunk_size)
+
+        # Read by Message._finish_init and Message.text.
+        self.parse_mode = None
+        self._self_id = 0
+        self._mb_entity_cache = {}
+
+
+    def is_connected(self):
+        return True
+
+
+    async def disconnect(self):
+        pass
+
+
+    async def request(self, name, request, duration=0):
+        while True:
+            await self.limiter.acquire(name)
+            self.requests += 1
+            await asyncio.sleep(self.latency + duration)
+            if self.flood_rate and self.rng.random() < self.flood_rate:
+                self.flood_waits += 1
+                self.limiter.flood_wait(name, request, self.flood_seconds)
+                continue
+            self.limiter.success(name)
+            return
+
+
+    def make_message(self, chat_id, msg_id):
+        rng = random.Random(hash((self.seed, chat_id, msg_id)))
+        channel_id, _ = resolve_id(chat_id)
+        date = EPOCH + timedelta(minutes=msg_id)
+        media_id = channel_id * 10**7 + msg_id
+
+        media = None
+        kind = rng.random()
+        if kind < self.photo_ratio:
+            size = rng.randint(self.photo_size // 2, self.photo_size * 3 // 2)
+            media = MessageMediaPhoto(photo=Photo(
+                id=media_id, access_hash=rng.getrandbits(63), file_reference=b'ref', date=date,
+                sizes=[PhotoSize(type='y', w=1280, h=1280, size=size)], dc_id=rng.randint(1, 5),
+            ))
+        elif kind < self.photo_ratio + self.document_ratio:
+            size = rng.randint(self.document_size // 2, self.document_size * 3 // 2)
+            media = MessageMediaDocument(document=Document(
+                id=media_id, access_hash=rng.getrandbits(63), file_reference=b'ref', date=date,
+                mime_type='video/mp4', size=size, dc_id=rng.randint(1, 5),
+                attributes=[DocumentAttributeFilename(f'{msg_id}.mp4')],
+            ))
+
+        msg = Message(
+            id=msg_id,
+            peer_id=PeerChannel(channel_id),
+            date=date,
+            message=' '.join(rng.choices(WORDS, k=rng.randint(0, 30))),
+            from_id=PeerUser(rng.randint(1, 1000)),
+            media=media,
+        )
+        msg._finish_init(self, {}, None)
+        return msg
+
+
+    async def iter_messages(self, chat_id, limit=None, reverse=False, min_id=0, max_id=0, **kwargs):
+        '''
+        Messages between min_id and max_id, both exclusive, fetched in
+        requests of HISTORY_PAGE like GetHistoryRequest.
+        '''
+        top = self.chats[chat_id]
+        ids = range(min_id + 1, min(max_id - 1 if max_id else top, top) + 1)
+        if not reverse:
+            ids = reversed(ids)
+        ids = list(ids)[:limit]
+        for i in range(0, len(ids), HISTORY_PAGE):
+            await self.request('history', 'GetHistoryRequest')
+            for msg_id in ids[i:i+HISTORY_PAGE]:
+                yield self.make_message(chat_id, msg_id)
+
+
+    async def get_messages(self, chat_id, limit=None, ids=None, **kwargs):
+        if ids is None:
+            return [msg async for msg in self.iter_messages(chat_id, limit=limit, **kwargs)]
+        await self.request('history', 'GetMessagesRequest')
+        if isinstance(ids, int):
+            return self.make_message(chat_id, ids) if 0 < ids <= self.chats[chat_id] else None
+        return [self.make_message(chat_id, i) if 0 < i <= self.chats[chat_id] else None for i in ids]
+
+
+    def content(self, media_id, offset, length):
+        '''
+        Bytes of media_id at offset, unique per media so no two files deduplicate.
+        '''
+        header = struct.pack('<qq', media_id, offset)
+        return (header + self.block)[:length]
+
+
+    async def iter_download(self, location, offset=0, limit=None, request_size=None, file_size=None, dc_id=None, **kwargs):
+        request_size = min(request_size or self.chunk_size, self.chunk_size)
+        end = file_size if limit is None else min(file_size, offset + limit * request_size)
+        while offset < end:
+            length = min(request_size, end - offset)
+            await self.request('download', 'GetFileRequest', length / self.bandwidth if self.bandwidth else 0)
+            yield self.content(location.id, offset, length)
+            offset += length
+
+
+    async def download_file(self, location, file=bytes, file_size=None, dc_id=None, **kwargs):
+        return b''.join([chunk async for chunk in self.iter_download(location, file_size=file_size, dc_id=dc_id)])
+
+
+    async def download_media(self, message, file=bytes, **kwargs):
+        media = message.photo or message.document
+        size = media.sizes[-1].size if message.photo else media.size
+        return b''.join([chunk async for chunk in self.iter_download(media, file_size=size)])
@@ -0,0 +1,101 @@
+'''
+Compare the "insert" and "copy" ingest paths of write_msgs on the configured
+database, with synthetic pages of messages and media. COPY needs Postgres,
+on SQLite run with --modes insert.
+
+    APPDATA=/appdata python benchmarks/ingest.py --messages 200000 --page 2000
+
+Rows are written to made up chats and removed afterwards.
+'''
+import random
+import argparse
+from time import perf_counter
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete
+
+from tgsync.config import config
+from tgsync.core.sync_chat import write_msgs
+from tgsync.db.session import session_generator, engine
+from tgsync.db.migrate import migrate
+from tgsync.db.entities import MessageEntity, PhotoEntity, DocumentEntity, ChatStateEntity
+
+
+CHATS = {'insert': -1009999999901, 'copy': -1009999999902}
+
+
+def make_page(chat_id, first_id, size, rng):
+    msg_dicts, photo_dicts, document_dicts = [], [], []
+    date = datetime(2024, 1, 1)
+    for msg_id in range(first_id, first_id + size):
+        msg_dict = {
+            'id': msg_id,
+            'chat_id': chat_id,
+            'sender_id': rng.randrange(1, 10**9),
+            'date': date + timedelta(seconds=msg_id),
+            'edit_date': None,
+            'message': ' '.join(rng.choice(('lorem', 'ipsum', 'dolor', 'sit', 'amet', '你好', 'tab\there')) for _ in range(rng.randrange(1, 40))),
+            'reply_to_msg_id': None, 'reply_to_chat_id': None, 'reply_to_sender_id': None,
+            'fwd_from_msg_id': None, 'fwd_from_chat_id': None, 'fwd_from_sender_id': None, 'fwd_from_date': None,
+            'photo_id': None,
+            'document_id': None,
+            'linked': False,
+            'deleted': False,
+        }
+        kind = rng.random()
+        media_id = -(abs(chat_id) % 100 * 10**9 + msg_id)
+        location = {'access_hash': rng.getrandbits(63), 'file_reference': rng.randbytes(32), 'dc_id': rng.randrange(1, 6)}
+        if kind < 0.2:
+            msg_dict['photo_id'] = media_id
+            photo_dicts.append({'id': media_id, 'saved': False, 'thumb_size': 'y', 'size': rng.randrange(10**6), **location})
+        elif kind < 0.3:
+            msg_dict['document_id'] = media_id
+            document_dicts.append({'id': media_id, 'type': 'video/mp4', 'size': rng.randrange(10**8),
+                                   'name': f'{msg_id}.mp4', 'saved': False, **location})
+        msg_dicts.append(msg_dict)
+    return msg_dicts, photo_dicts, document_dicts
+
+
+def cleanup(chat_id):
+    with session_generator() as session:
+        media_ids = session.execute(
+            delete(MessageEntity)
+            .where(MessageEntity.chat_id == chat_id)
+            .returning(MessageEntity.photo_id, MessageEntity.document_id)
+        ).all()
+        session.execute(delete(PhotoEntity).where(PhotoEntity.id.in_([p for p, _ in media_ids if p])))
+        session.execute(delete(DocumentEntity).where(DocumentEntity.id.in_([d for _, d in media_ids if d])))
+        session.execute(delete(ChatStateEntity).where(ChatStateEntity.chat_id == chat_id))
+
+
+def run(mode, messages, page):
+    config['tg']['ingest'] = mode
+    chat_id = CHATS[mode]
+    rng = random.Random(0)
+    pages = [make_page(chat_id, first_id, page, rng) for first_id in range(1, messages + 1, page)]
+
+    cleanup(chat_id)
+    start = perf_counter()
+    for msg_dicts, photo_dicts, document_dicts in pages:
+        write_msgs(msg_dicts, photo_dicts, document_dicts)
+    elapsed = perf_counter() - start
+    cleanup(chat_id)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--page', type=int, default=config['tg']['message_limit'])
+    parser.add_argument('--modes', nargs='+', choices=list(CHATS), default=list(CHATS))
+    args = parser.parse_args()
+
+    migrate(engine)
+    for mode in args.modes:
+        elapsed = run(mode, args.messages, args.page)
+        print(f'{mode:>6}: {args.messages} messages in pages of {args.page}, '
+              f'{elapsed:.2f}s, {args.messages / elapsed:.0f} msgs/s')
+
+
+if __name__ == '__main__':
+    main()
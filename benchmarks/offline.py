@@ -0,0 +1,259 @@
+'''
+Run sync_chat, save_all and link_media against FakeClient on a scratch
+database and media dir, and report messages/s, MB/s, database round trips
+and peak RSS of each phase.
+
+    PYTHONPATH=src python benchmarks/offline.py --chats 2 --messages 20000 --latency 0.02
+    PYTHONPATH=src python benchmarks/offline.py --json results.json
+    PYTHONPATH=src python benchmarks/offline.py --baseline results.json --tolerance 0.2
+
+With --baseline the run exits with status 1 when a phase got slower, made
+more round trips or used more memory than the baseline by more than the
+tolerance. Latency, bandwidth and flood waits are simulated, so timings
+compare runs of this script with the same options, not real syncs.
+'''
+import os
+import sys
+import json
+import shutil
+import asyncio
+import argparse
+import resource
+import tempfile
+import threading
+from time import perf_counter
+from pathlib import Path
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chats', type=int, default=2)
+    parser.add_argument('--messages', type=int, default=10000, help='Messages per chat')
+    parser.add_argument('--page', type=int, default=2000, help='tg.message_limit')
+    parser.add_argument('--pipeline-depth', type=int, default=2)
+    parser.add_argument('--ingest', choices=['insert', 'copy'], default='insert')
+    parser.add_argument('--backfill', type=int, nargs=2, metavar=('PARTITIONS', 'CONCURRENT'), help='tg.backfill, off by default')
+    parser.add_argument('--workers', type=int, default=4, help='download.concurrent')
+    parser.add_argument('--latency', type=float, default=0.01, help='Seconds per request')
+    parser.add_argument('--bandwidth', type=float, default=0, help='MB/s per download connection, 0 for unlimited')
+    parser.add_argument('--chunk-size', type=int, default=512*1024, help='Bytes served per download request')
+    parser.add_argument('--photo-ratio', type=float, default=0.2)
+    parser.add_argument('--document-ratio', type=float, default=0.05)
+    parser.add_argument('--photo-size', type=int, default=200*1024)
+    parser.add_argument('--document-size', type=int, default=2*1024**2)
+    parser.add_argument('--flood-rate', type=float, default=0, help='Probability of a flood wait per request')
+    parser.add_argument('--flood-seconds', type=int, default=1)
+    parser.add_argument('--history-rate', type=float, help='Rate limit of history requests per second, none by default')
+    parser.add_argument('--db-url', help='Database to use, a scratch SQLite file by default. Tables are not cleaned up')
+    parser.add_argument('--workdir', help='Directory for config, database and media, a temporary one by default')
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--json', help='Write the results to this file')
+    parser.add_argument('--baseline', help='Results of an earlier run written with --json to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    return parser.parse_args()
+
+
+def write_config(workdir, args):
+    chats = {str(-1001000000000 - i): {'media': True} for i in range(1, args.chats + 1)}
+    rate_limits = {}
+    if args.history_rate:
+        rate_limits['history'] = {'rate': args.history_rate, 'burst': 1}
+    backfill = None
+    if args.backfill:
+        backfill = {'partitions': args.backfill[0], 'concurrent': args.backfill[1]}
+    config = {
+        'log': {'level': args.log_level, 'dir': None},
+        'db': {'url': args.db_url or f'sqlite:///{workdir / "tgsync.db"}'},
+        'tg': {
+            'api_id': -1,
+            'api_hash': '',
+            'session': str(workdir / 'fake.session'),
+            'message_limit': args.page,
+            'pipeline_depth': args.pipeline_depth,
+            'ingest': args.ingest,
+            'backfill': backfill,
+            'rate_limits': rate_limits,
+            'flood_backoff': args.flood_seconds,
+            'chats': chats,
+        },
+        'download': {
+            'media': str(workdir / 'media'),
+            'incomplete': str(workdir / 'incomplete'),
+            'concurrent': args.workers,
+            'timeout': 60,
+            'summary_interval': 3600,
+        },
+    }
+    with open(workdir / 'config.json', 'w') as f:
+        json.dump(config, f, indent=2)
+    return [int(chat_id) for chat_id in chats]
+
+
+def peak_rss():
+    # KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024**2 if sys.platform == 'darwin' else rss / 1024
+
+
+class Phase:
+    '''
+    Wall time, database round trips and bytes downloaded between start and stop.
+    '''
+
+    def __init__(self, name, round_trips, downloaded):
+        self.name = name
+        self.round_trips = round_trips
+        self.downloaded = downloaded
+        self.items = 0
+
+
+    def __enter__(self):
+        self.start = (perf_counter(), self.round_trips(), self.downloaded())
+        return self
+
+
+    def __exit__(self, *exc):
+        start, round_trips, downloaded = self.start
+        self.seconds = perf_counter() - start
+        self.db_round_trips = self.round_trips() - round_trips
+        self.megabytes = (self.downloaded() - downloaded) / 1024**2
+        self.peak_rss = peak_rss()
+
+
+    def result(self):
+        return {
+            'seconds': round(self.seconds, 3),
+            'items': self.items,
+            'items_per_second': round(self.items / self.seconds, 1),
+            'mb_per_second': round(self.megabytes / self.seconds, 2),
+            'db_round_trips': self.db_round_trips,
+            'peak_rss_mb': round(self.peak_rss, 1),
+        }
+
+
+async def run(args, chat_ids):
+    # Imported once APPDATA points at the scratch config.
+    from sqlalchemy import event, select, func
+
+    from tgsync.metrics import DOWNLOAD_BYTES
+    from tgsync.core.concurrency import total
+    from tgsync.core.sync_chat import sync_chat
+    from tgsync.core.save_media import save_all
+    from tgsync.core.link_media import link_media
+    from tgsync.db.session import engine, session_generator, run_db
+    from tgsync.db.migrate import migrate
+    from tgsync.db.entities import PhotoEntity, DocumentEntity
+    from fake_client import FakeClient
+
+    lock = threading.Lock()
+    executed = 0
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count_round_trip(*args):
+        nonlocal executed
+        with lock:
+            executed += 1
+
+    def count_saved():
+        with session_generator() as session:
+            return sum(
+                session.scalar(select(func.count()).select_from(entity_class).where(entity_class.saved == True))
+                for entity_class in (PhotoEntity, DocumentEntity)
+            )
+
+    await run_db(migrate, engine)
+    client = FakeClient(
+        {chat_id: args.messages for chat_id in chat_ids},
+        latency=args.latency,
+        bandwidth=args.bandwidth * 1024**2,
+        chunk_size=args.chunk_size,
+        photo_ratio=args.photo_ratio,
+        document_ratio=args.document_ratio,
+        photo_size=args.photo_size,
+        document_size=args.document_size,
+        flood_rate=args.flood_rate,
+        flood_seconds=args.flood_seconds,
+    )
+
+    phases = []
+    def phase(name):
+        phases.append(Phase(name, lambda: executed, lambda: total(DOWNLOAD_BYTES)))
+        return phases[-1]
+
+    with phase('sync') as p:
+        for chat_id in chat_ids:
+            await sync_chat(client, chat_id)
+        p.items = args.messages * len(chat_ids)
+
+    saved = await run_db(count_saved)
+    with phase('download') as p:
+        for chat_id in chat_ids:
+            await save_all(client, chat_id, True)
+            await save_all(client, chat_id, False)
+    p.items = await run_db(count_saved) - saved
+
+    with phase('link') as p:
+        p.items = await run_db(link_media)
+
+    return {p.name: p.result() for p in phases}, client
+
+
+def regressions(results, baseline, tolerance):
+    '''
+    return a description of every metric worse than baseline by more than tolerance
+    '''
+    found = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for metric, higher_is_better in (('items_per_second', True), ('mb_per_second', True),
+                                         ('db_round_trips', False), ('peak_rss_mb', False)):
+            old, new = base[metric], result[metric]
+            if not old:
+                continue
+            change = (new - old) / old
+            if (-change if higher_is_better else change) > tolerance:
+                found.append(f'{name} {metric}: {old} -> {new} ({change:+.0%})')
+    return found
+
+
+def main():
+    args = parse_args()
+    if args.ingest == 'copy' and not (args.db_url or '').startswith('postgresql'):
+        sys.exit('--ingest copy needs a Postgres --db-url')
+    workdir = Path(args.workdir) if args.workdir else Path(tempfile.mkdtemp(prefix='tgsync-bench-'))
+    workdir.mkdir(parents=True, exist_ok=True)
+    chat_ids = write_config(workdir, args)
+    os.environ['APPDATA'] = str(workdir)
+
+    from tabulate import tabulate
+
+    try:
+        results, client = asyncio.run(run(args, chat_ids))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(tabulate(
+        [[name, r['seconds'], r['items'], r['items_per_second'], r['mb_per_second'], r['db_round_trips'], r['peak_rss_mb']]
+         for name, r in results.items()],
+        headers=['phase', 'seconds', 'items', 'items/s', 'MB/s', 'DB round trips', 'peak RSS MB'],
+    ))
+    print(f'{client.requests} fake requests, {client.flood_waits} flood waits')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for regression in found:
+            print(f'Regression: {regression}')
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import asyncio
+from time import monotonic
+from pathlib import Path
+from collections import defaultdict
+
+from telethon import errors
+
+from tgsync.config import config
+from tgsync.logger import logger
+from tgsync.core.get_client import get_client
+from tgsync.core.list_chats import list_chats
+from tgsync.metrics import CLIENT_HEALTHY
+
+
+FAILOVER_ERRORS = (errors.FloodWaitError, errors.FloodPremiumWaitError, ConnectionError)
+
+
+def session_names():
+    '''
+    `tg.session` first, followed by every extra session in `tg.sessions`.
+    '''
+    sessions = [config['tg']['session']]
+    sessions += [s for s in config['tg'].get('sessions', []) if s not in sessions]
+    return sessions
+
+
+class ClientPool:
+    '''
+    Clients of all configured sessions. The first one is the primary,
+    used for everything that needs a single account.
+
+    Chat work goes through run(), which picks the healthiest client
+    among those having the chat in their dialogs: connected, not paused
+    by a flood wait, fewest recent failures and least work in flight.
+    A flood wait longer than `tg.flood_sleep_threshold` or a lost
+    connection hands the work over to the next client.
+    '''
+
+    def __init__(self, clients):
+        self.clients = clients
+        self.names = {client: Path(getattr(getattr(client, 'session', None), 'filename', None) or str(i)).stem
+                      for i, client in enumerate(clients)}
+        self.chats = {}
+        self.in_flight = defaultdict(int)
+        self.failures = defaultdict(int)
+        self.resting_until = defaultdict(float)
+        for client in clients:
+            CLIENT_HEALTHY.labels(self.names[client]).set_function(lambda client=client: int(self.healthy(client)))
+
+
+    @classmethod
+    async def create(cls):
+        clients = []
+        for session in session_names():
+            clients.append(await get_client(session))
+        if len(clients) > 1:
+            logger.info(f'Client pool of {len(clients)} sessions')
+        return cls(clients)
+
+
+    @property
+    def primary(self):
+        return self.clients[0]
+
+
+    async def load_chats(self):
+        '''
+        Record the dialogs of every client, saving those of the primary to chats.json.
+        '''
+        for client in self.clients:
+            chats = await list_chats(client, save=client is self.primary)
+            self.chats[client] = {int(chat_id) for chat_id in chats.values()}
+
+
+    def healthy(self, client):
+        limiter = getattr(client, 'limiter', None)
+        paused = limiter and limiter.paused_for(None) > 0
+        return client.is_connected() and not paused and self.resting_until[client] <= monotonic()
+
+
+    def candidates(self, chat_id, exclude=()):
+        clients = [
+            client for client in self.clients
+            if client not in exclude and (client not in self.chats or chat_id in self.chats[client])
+        ]
+        return sorted(clients, key=lambda c: (not self.healthy(c), self.failures[c], self.in_flight[c]))
+
+
+    async def run(self, chat_id, fn, *args, **kwargs):
+        '''
+        await fn(client, *args, **kwargs) with the best client for chat_id,
+        failing over to the others in turn.
+        '''
+        tried = []
+        last_error = None
+        while True:
+            candidates = self.candidates(chat_id, tried) or ([] if tried else [self.primary])
+            if not candidates:
+                raise last_error
+            client = candidates[0]
+
+            self.in_flight[client] += 1
+            try:
+                result = await fn(client, *args, **kwargs)
+            except FAILOVER_ERRORS as e:
+                last_error = e
+                tried.append(client)
+                self.failures[client] += 1
+                self.resting_until[client] = monotonic() + getattr(e, 'seconds', 30)
+                logger.warning(f'{self.names[client]} failed on {chat_id} with {type(e).__name__}, '
+                               f'{len(self.candidates(chat_id, tried))} other clients left')
+                continue
+            finally:
+                self.in_flight[client] -= 1
+
+            self.failures[client] = 0
+            return result
+
+
+    async def disconnect(self):
+        await asyncio.gather(*(client.disconnect() for client in self.clients), return_exceptions=True)
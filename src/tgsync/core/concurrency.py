@@ -0,0 +1,97 @@
+import asyncio
+
+from tgsync.config import config
+from tgsync.logger import logger
+from tgsync.metrics import DOWNLOAD_BYTES, TIMEOUTS, FLOOD_WAITS, CONCURRENCY
+
+
+DOWNLOAD_REQUESTS = ('GetFileRequest', 'GetCdnFileRequest')
+
+
+def total(metric, keys=None):
+    return sum(child.value for key, child in list(metric.children.items()) if keys is None or key in keys)
+
+
+class AdaptiveConcurrency:
+    '''
+    Number of downloads allowed to run at once, between `download.adaptive.min`
+    and `download.concurrent`.
+
+    Every `download.adaptive.interval` seconds the aggregate throughput is
+    compared with the previous interval: the limit is raised by one while
+    it keeps improving, stepped back when a raise made it worse, and
+    halved on any download timeout or flood wait. Without `download.adaptive`
+    the limit stays at `download.concurrent`.
+    '''
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.maximum = config['download']['concurrent']
+        adaptive = config['download'].get('adaptive')
+        self.adaptive = adaptive is not None
+        self.minimum = min(adaptive.get('min', 1), self.maximum) if self.adaptive else self.maximum
+        self.interval = adaptive.get('interval', 10) if self.adaptive else 0
+        self.limit = self.minimum
+        self.active = 0
+        self.changed = asyncio.Condition()
+        CONCURRENCY.set(self.limit)
+
+
+    async def acquire(self):
+        async with self.changed:
+            await self.changed.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+
+    async def release(self):
+        async with self.changed:
+            self.active -= 1
+            self.changed.notify_all()
+
+
+    async def set_limit(self, limit, reason):
+        limit = max(self.minimum, min(self.maximum, limit))
+        if limit == self.limit:
+            return
+        logger.info(f'Download concurrency {self.limit} -> {limit}: {reason}')
+        async with self.changed:
+            self.limit = limit
+            self.changed.notify_all()
+        CONCURRENCY.set(limit)
+
+
+    def sample(self):
+        return (
+            total(DOWNLOAD_BYTES),
+            total(TIMEOUTS, {('document',), ('photo',)}) + total(FLOOD_WAITS, {(r,) for r in DOWNLOAD_REQUESTS}),
+        )
+
+
+    async def run(self):
+        last_bytes, last_errors = self.sample()
+        last_speed = 0
+        raised = False
+        while True:
+            await asyncio.sleep(self.interval)
+            received, errors = self.sample()
+            speed = (received - last_bytes) / self.interval
+            congested = errors > last_errors
+            last_bytes, last_errors = received, errors
+
+            if congested:
+                await self.set_limit(self.limit // 2, 'timeouts or flood waits')
+                raised = False
+            elif self.queue.qsize() == 0:
+                # Throughput is bound by the backlog, not by the limit.
+                raised = False
+            elif raised and speed < last_speed * 0.9:
+                await self.set_limit(self.limit - 1, f'throughput fell to {speed / 1024**2:.2f}MiB/s')
+                raised = False
+            elif not raised or speed > last_speed * 1.05:
+                limit = self.limit
+                await self.set_limit(limit + 1, f'throughput {speed / 1024**2:.2f}MiB/s')
+                raised = self.limit > limit
+            else:
+                # No gain from the last raise, hold for an interval before probing again.
+                raised = False
+            last_speed = speed
@@ -0,0 +1,84 @@
+from hashlib import sha256
+
+
+BLOCK_SIZE = 1024 * 1024
+
+
+class BlockHasher:
+    '''
+    Hashes a stream starting at a BLOCK_SIZE aligned offset block by block,
+    storing the hex digest of every completed block into `blocks` by index,
+    so ranges of one file can be hashed concurrently and out of order.
+    '''
+
+    def __init__(self, offset, blocks):
+        if offset % BLOCK_SIZE:
+            raise ValueError(f'Offset {offset} is not aligned to {BLOCK_SIZE}')
+        self.index = offset // BLOCK_SIZE
+        self.blocks = blocks
+        self.hasher = sha256()
+        self.filled = 0
+
+
+    def update(self, data):
+        view = memoryview(data)
+        while view:
+            take = min(BLOCK_SIZE - self.filled, len(view))
+            self.hasher.update(view[:take])
+            self.filled += take
+            view = view[take:]
+            if self.filled == BLOCK_SIZE:
+                self.finish_block()
+
+
+    def finish_block(self):
+        self.blocks[self.index] = self.hasher.hexdigest()
+        self.index += 1
+        self.hasher = sha256()
+        self.filled = 0
+
+
+    def close(self):
+        '''
+        Call once the end of the file is reached to hash its last, short block.
+        '''
+        if self.filled:
+            self.finish_block()
+
+
+def block_count(size):
+    return -(-size // BLOCK_SIZE)
+
+
+def content_hash(blocks, size):
+    '''
+    Combine block digests into the content hash of a file of `size` bytes,
+    None if any block is missing. This is the sha256 of the concatenated
+    block digests, it differs from the sha256 of the file itself.
+    '''
+    digests = []
+    for i in range(block_count(size)):
+        if i not in blocks:
+            return None
+        digests.append(bytes.fromhex(blocks[i]))
+    return sha256(b''.join(digests)).hexdigest()
+
+
+def hash_bytes(data):
+    blocks = {}
+    hasher = BlockHasher(0, blocks)
+    hasher.update(data)
+    hasher.close()
+    return content_hash(blocks, len(data))
+
+
+def hash_file(path):
+    blocks = {}
+    hasher = BlockHasher(0, blocks)
+    size = 0
+    with open(path, 'rb') as f:
+        while chunk := f.read(BLOCK_SIZE):
+            hasher.update(chunk)
+            size += len(chunk)
+    hasher.close()
+    return content_hash(blocks, size)
@@ -0,0 +1,133 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import select, update, case
+
+from tgsync.config import config
+from tgsync.logger import logger
+from tgsync.core.content_hash import hash_file
+from tgsync.core.link_media import repo_path, link_paths
+from tgsync.core.save_media import replace_with_link
+from tgsync.db.session import session_generator
+from tgsync.db.entities import MessageEntity, PhotoEntity, DocumentEntity
+
+
+def get_saved_media(entity_class):
+    with session_generator() as session:
+        if entity_class is PhotoEntity:
+            rows = session.execute(
+                select(PhotoEntity.id, PhotoEntity.content_hash).where(PhotoEntity.saved == True)
+            ).all()
+            return [(repo_path(photo_id=media_id), media_id, digest) for media_id, digest in rows]
+
+        rows = session.execute(
+            select(DocumentEntity.id, DocumentEntity.type, DocumentEntity.content_hash).where(DocumentEntity.saved == True)
+        ).all()
+        return [(repo_path(document_id=media_id, document_type=type_), media_id, digest) for media_id, type_, digest in rows]
+
+
+def write_hashes(entity_class, hashes):
+    with session_generator() as session:
+        session.execute(
+            update(entity_class)
+            .where(entity_class.id.in_(list(hashes)))
+            .values(content_hash=case(hashes, value=entity_class.id))
+        )
+
+
+def get_chat_links(entity_class, media_id):
+    media_col = MessageEntity.photo_id if entity_class is PhotoEntity else MessageEntity.document_id
+    with session_generator() as session:
+        rows = session.execute(
+            select(
+                MessageEntity.chat_id,
+                MessageEntity.id,
+                MessageEntity.photo_id,
+                MessageEntity.document_id,
+                DocumentEntity.name,
+                DocumentEntity.type,
+            )
+            .outerjoin(DocumentEntity, MessageEntity.document_id == DocumentEntity.id)
+            .where(media_col == media_id, MessageEntity.linked == True)
+        ).all()
+
+    links = []
+    for chat_id, msg_id, photo_id, document_id, name, type_ in rows:
+        _, filename = link_paths(msg_id, photo_id, document_id, name, type_)
+        links.append(config['download']['media'] / str(chat_id) / filename)
+    return links
+
+
+def hash_missing(entity_class, media, workers, batch_size=1000):
+    '''
+    Hash stored files without a recorded content hash, in parallel,
+    recording the results as they come in.
+
+    return {path: digest} of every stored file
+    '''
+    digests = {path: digest for path, _, digest in media if digest and os.path.exists(path)}
+    missing = [(path, media_id) for path, media_id, digest in media if not digest and os.path.exists(path)]
+    logger.info(f'Hashing {len(missing)} {entity_class.__tablename__} files with {workers} threads')
+
+    hashes = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for (path, media_id), digest in zip(missing, executor.map(hash_file, (path for path, _ in missing))):
+            digests[path] = digest
+            hashes[media_id] = digest
+            if len(hashes) >= batch_size:
+                write_hashes(entity_class, hashes)
+                hashes = {}
+    if hashes:
+        write_hashes(entity_class, hashes)
+
+    return digests
+
+
+def dedupe(entity_class, workers, dry_run=False):
+    media = get_saved_media(entity_class)
+    digests = hash_missing(entity_class, media, workers)
+
+    groups = {}
+    for path, media_id, _ in media:
+        if path in digests:
+            groups.setdefault(digests[path], []).append((path, media_id))
+
+    freed = 0
+    for digest, copies in groups.items():
+        if len(copies) < 2:
+            continue
+
+        canonical, _ = copies[0]
+        canonical_ino = os.stat(canonical).st_ino
+        for path, media_id in copies[1:]:
+            stat = os.stat(path)
+            if stat.st_ino == canonical_ino:
+                continue
+
+            logger.info(f'{path.name} has the same content as {canonical.name}')
+            freed += stat.st_size
+            if dry_run:
+                continue
+
+            for link in get_chat_links(entity_class, media_id):
+                if os.path.exists(link) and os.stat(link).st_ino == stat.st_ino:
+                    replace_with_link(canonical, link)
+            replace_with_link(canonical, path)
+
+    logger.info(f'{"Would free" if dry_run else "Freed"} {freed / 1024**3:.2f}GiB of {entity_class.__tablename__} files')
+    return freed
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Collapse stored media with identical content into one file')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='Files hashed in parallel')
+    parser.add_argument('-n', '--dry-run', action='store_true', help='Only report duplicates')
+    args = parser.parse_args()
+
+    for entity_class in (PhotoEntity, DocumentEntity):
+        dedupe(entity_class, args.workers, args.dry_run)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+import asyncio
+from heapq import heappush, heappop
+from itertools import count
+from collections import defaultdict
+
+from tgsync.config import config
+
+
+PRIORITIES = {
+    'photos_first': lambda job: 0 if job.is_photo else 1,
+    'by_dc': lambda job: job.dc_id or 0,
+    'documents_first': lambda job: 1 if job.is_photo else 0,
+    'smallest_first': lambda job: 0 if job.is_photo else job.size,
+    'oldest_first': lambda job: job.msg_id,
+    'newest_first': lambda job: -job.msg_id,
+}
+
+
+def make_priority(names):
+    '''
+    Combine the named PRIORITIES into one sort key, earlier names win,
+    callables may be given in place of names.
+    '''
+    keys = [PRIORITIES[name] if isinstance(name, str) else name for name in names]
+    return lambda job: tuple(key(job) for key in keys)
+
+
+def newest_first(names):
+    '''
+    names with message age reversed, for chats whose recent media matters first.
+    '''
+    if 'newest_first' in names:
+        return names
+    if 'oldest_first' in names:
+        return ['newest_first' if name == 'oldest_first' else name for name in names]
+    return [*names, 'newest_first']
+
+
+def media_key(job):
+    return ('photo' if job.is_photo else 'document', job.media_id)
+
+
+def chat_weight(chat_id):
+    return config['tg']['chats'].get(str(chat_id), {}).get('weight', 1)
+
+
+class DownloadQueue:
+    '''
+    Download queue of MediaJobs shared by all chats.
+
+    Every chat keeps its own backlog ordered by `download.priority`,
+    get() serves chats by stride scheduling so each chat receives
+    downloads in proportion to its `weight` in `tg.chats`, and a chat
+    that has been idle does not get to catch up on its missed turns.
+    set_priority() replaces the order of a single chat's backlog.
+    '''
+
+    def __init__(self, backlog, priority=None):
+        self.backlog = backlog
+        self.priority_names = priority or config['download'].get('priority', ['photos_first', 'by_dc', 'oldest_first'])
+        self.priority = make_priority(self.priority_names)
+        self.chat_priority = {}
+        self.heaps = defaultdict(list)
+        self.passes = defaultdict(float)
+        self.unfinished = defaultdict(int)
+        self.dcs = defaultdict(int)
+        self.media = set()
+        self.counter = count()
+        self.changed = asyncio.Condition()
+
+
+    def set_priority(self, chat_id, names):
+        self.chat_priority[chat_id] = make_priority(names)
+
+
+    def qsize(self):
+        return sum(len(heap) for heap in self.heaps.values())
+
+
+    def active_chats(self):
+        return [chat_id for chat_id, heap in self.heaps.items() if heap]
+
+
+    def active_dcs(self):
+        '''
+        DCs of the media queued or being downloaded.
+        '''
+        return {dc_id for dc_id, pending in self.dcs.items() if pending > 0}
+
+
+    async def put(self, chat_id, job):
+        async with self.changed:
+            await self.changed.wait_for(lambda: len(self.heaps[chat_id]) < self.backlog)
+
+            if media_key(job) in self.media:
+                return
+            self.media.add(media_key(job))
+
+            if not self.heaps[chat_id]:
+                active = self.active_chats()
+                if active:
+                    self.passes[chat_id] = max(self.passes[chat_id], min(self.passes[c] for c in active))
+
+            priority = self.chat_priority.get(chat_id, self.priority)
+            heappush(self.heaps[chat_id], (priority(job), next(self.counter), job))
+            self.unfinished[chat_id] += 1
+            self.dcs[job.dc_id] += 1
+            self.changed.notify_all()
+
+
+    async def get(self):
+        async with self.changed:
+            await self.changed.wait_for(self.qsize)
+
+            chat_id = min(self.active_chats(), key=lambda c: self.passes[c])
+            _, _, job = heappop(self.heaps[chat_id])
+            self.passes[chat_id] += 1 / chat_weight(chat_id)
+
+            self.changed.notify_all()
+            return job
+
+
+    async def task_done(self, job):
+        async with self.changed:
+            self.media.discard(media_key(job))
+            self.unfinished[job.chat_id] -= 1
+            self.dcs[job.dc_id] -= 1
+            self.changed.notify_all()
+
+
+    async def join(self, chat_id):
+        '''
+        Wait until every download queued for chat_id has finished.
+        '''
+        async with self.changed:
+            await self.changed.wait_for(lambda: self.unfinished[chat_id] <= 0)
@@ -0,0 +1,183 @@
+import os
+import json
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import select
+
+from tgsync.config import config
+from tgsync.logger import logger
+from tgsync.core.link_media import link_paths
+from tgsync.core.ledger import synced_through
+from tgsync.db.session import session_generator
+from tgsync.db.entities import MessageEntity, DocumentEntity
+
+
+BATCH_SIZE = 10000
+COLUMNS = [column.name for column in MessageEntity.__table__.columns]
+
+
+def read_watermark(chat_dir):
+    try:
+        with open(chat_dir / 'watermark.json', 'r') as f:
+            return json.load(f)['last_id']
+    except FileNotFoundError:
+        return 0
+
+
+def write_watermark(chat_dir, last_id):
+    temp_path = chat_dir / 'watermark.json.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump({'last_id': last_id}, f)
+    os.replace(temp_path, chat_dir / 'watermark.json')
+
+
+def stream_batches(chat_id, after, until, media):
+    '''
+    Yield lists of row dicts of chat_id after message `after` up to `until`,
+    oldest first, read through a server-side cursor so only one batch is in memory.
+    '''
+    stmt = (
+        select(
+            MessageEntity.__table__,
+            DocumentEntity.name.label('document_name'),
+            DocumentEntity.type.label('document_type'),
+        )
+        .outerjoin(DocumentEntity, MessageEntity.document_id == DocumentEntity.id)
+        .where(MessageEntity.chat_id == chat_id, MessageEntity.id > after, MessageEntity.id <= until)
+        .order_by(MessageEntity.id)
+        .execution_options(stream_results=True)
+    )
+    with session_generator() as session:
+        for partition in session.execute(stmt).partitions(BATCH_SIZE):
+            batch = []
+            for msg in partition:
+                row = {column: getattr(msg, column) for column in COLUMNS}
+                if media:
+                    row['media_path'] = None
+                    if msg.linked and (msg.photo_id or msg.document_id):
+                        _, filename = link_paths(msg.id, msg.photo_id, msg.document_id, msg.document_name, msg.document_type)
+                        row['media_path'] = f'{chat_id}/{filename}'
+                batch.append(row)
+            yield batch
+
+
+class JsonlWriter:
+    def __init__(self, path, media):
+        self.file = open(path, 'w', encoding='utf-8')
+
+
+    def write(self, batch):
+        self.file.writelines(json.dumps(row, ensure_ascii=False, default=lambda v: v.isoformat()) + '\n' for row in batch)
+
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    def __init__(self, path, media):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        types = {'BigInteger': pa.int64(), 'DateTime': pa.timestamp('us'), 'Text': pa.string(), 'Boolean': pa.bool_()}
+        fields = [pa.field(column.name, types[type(column.type).__name__]) for column in MessageEntity.__table__.columns]
+        if media:
+            fields.append(pa.field('media_path', pa.string()))
+        self.pa = pa
+        self.schema = pa.schema(fields)
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+
+    def write(self, batch):
+        self.writer.write_table(self.pa.Table.from_pylist(batch, schema=self.schema))
+
+
+    def close(self):
+        self.writer.close()
+
+
+WRITERS = {'jsonl': JsonlWriter, 'parquet': ParquetWriter}
+
+
+def export_chat(chat_id, output, format, media=False, full=False):
+    '''
+    Write the messages of chat_id added since the last export into a new
+    `<output>/<chat_id>/<first_id>-<last_id>.<format>` file, then move
+    the chat's watermark up to the last message written.
+
+    Only messages up to the end of the chat's first synced range are
+    exported, a message stored later always has a higher id than the
+    watermark, even when it fills a gap or belongs to a backfill partition
+    or was written ahead by live mode.
+
+    Messages edited after being exported are not exported again,
+    full starts over from the first message.
+
+    return the number of messages exported
+    '''
+    chat_dir = Path(output) / str(chat_id)
+    chat_dir.mkdir(parents=True, exist_ok=True)
+    after = 0 if full else read_watermark(chat_dir)
+    until = synced_through(chat_id)
+
+    temp_path = chat_dir / f'.export.{format}.tmp'
+    writer = None
+    first_id, last_id, count = None, after, 0
+    try:
+        for batch in stream_batches(chat_id, after, until, media):
+            if writer is None:
+                writer = WRITERS[format](temp_path, media)
+                first_id = batch[0]['id']
+            writer.write(batch)
+            last_id = batch[-1]['id']
+            count += len(batch)
+    except BaseException:
+        if writer:
+            writer.close()
+            os.remove(temp_path)
+        raise
+
+    if writer is None:
+        logger.info(f'Nothing new to export from {chat_id}, synced without gaps up to {until}')
+        return 0
+
+    writer.close()
+    os.replace(temp_path, chat_dir / f'{first_id:010d}-{last_id:010d}.{format}')
+    write_watermark(chat_dir, last_id)
+    logger.info(f'Exported {count} messages of {chat_id} up to {last_id}')
+    return count
+
+
+def add_parser(subparsers):
+    parser = subparsers.add_parser('export', help='Export synced messages to JSONL or Parquet files')
+    parser.add_argument('output', help='Directory to write one sub directory of files per chat into')
+    parser.add_argument('-c', '--chat', type=int, action='append', help='Chat to export, may be repeated, all configured chats by default')
+    parser.add_argument('--format', choices=list(WRITERS), default='jsonl')
+    parser.add_argument('--media', action='store_true', help='Add the path of linked media relative to the media dir')
+    parser.add_argument('--full', action='store_true', help='Export everything again, ignoring the watermarks')
+    parser.add_argument('-w', '--workers', type=int, default=4, help='Chats exported in parallel')
+    return parser
+
+
+def main(args):
+    chat_ids = args.chat or [int(chat_id) for chat_id in config['tg']['chats']]
+    if args.format == 'parquet':
+        try:
+            import pyarrow
+        except ImportError:
+            logger.error('Parquet export requires pyarrow: pip install tgsync[parquet]')
+            return
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {
+            chat_id: executor.submit(export_chat, chat_id, args.output, args.format, args.media, args.full)
+            for chat_id in chat_ids
+        }
+    total = 0
+    for chat_id, future in futures.items():
+        try:
+            total += future.result()
+        except Exception as e:
+            logger.error(f'Failed to export {chat_id}: {e!r}')
+    logger.info(f'Exported {total} messages from {len(chat_ids)} chats')
@@ -1,11 +1,42 @@
-from telethon import TelegramClient
+from telethon import TelegramClient, errors
+from telethon.utils import is_list_like
 from urllib.parse import urlparse
 
 from tgsync.config import appdata, config
 from tgsync.logger import logger
+from tgsync.core.rate_limit import RateLimiter, method_class
 
 
-async def get_client():
+class RateLimitedClient(TelegramClient):
+    '''
+    TelegramClient sending every request through its RateLimiter.
+
+    Telethon's own flood sleeping is disabled so waits are shared with
+    the limiter, waits longer than `tg.flood_sleep_threshold` are raised.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, flood_sleep_threshold=0, **kwargs)
+        self.limiter = RateLimiter()
+        self.flood_threshold = config['tg'].get('flood_sleep_threshold', 60)
+
+
+    async def _call(self, sender, request, ordered=False, flood_sleep_threshold=None):
+        name = method_class(request[0] if is_list_like(request) else request)
+        while True:
+            await self.limiter.acquire(name)
+            try:
+                result = await super()._call(sender, request, ordered=ordered, flood_sleep_threshold=0)
+            except (errors.FloodWaitError, errors.FloodPremiumWaitError) as e:
+                self.limiter.flood_wait(name, type(e.request).__name__, e.seconds)
+                if e.seconds > self.flood_threshold:
+                    raise
+                continue
+            self.limiter.success(name)
+            return result
+
+
+async def get_client(session=None):
     proxy_url = config['tg'].get('proxy')
     if proxy_url:
         components = urlparse(proxy_url)
@@ -23,8 +54,8 @@ async def get_client():
     else:
         proxy = None
 
-    client = TelegramClient(
-        appdata / config['tg']['session'],
+    client = RateLimitedClient(
+        appdata / (session or config['tg']['session']),
         config['tg']['api_id'],
         config['tg']['api_hash'],
         proxy=proxy,
@@ -0,0 +1,129 @@
+from tabulate import tabulate
+from sqlalchemy import select, delete, insert
+
+from tgsync.config import config
+from tgsync.logger import logger
+from tgsync.db.session import session_generator
+from tgsync.db.entities import SyncedRangeEntity, ChatStateEntity
+
+
+def add_range(session, chat_id, start_id, end_id):
+    '''
+    Record [start_id, end_id] of chat_id as synced, merged with every
+    range it overlaps or touches.
+
+    Must run after update_chat_state in the same transaction, the lock
+    it takes on the chat_state row keeps concurrent merges of one chat apart.
+    '''
+    neighbours = session.execute(
+        select(SyncedRangeEntity.start_id, SyncedRangeEntity.end_id)
+        .where(
+            SyncedRangeEntity.chat_id == chat_id,
+            SyncedRangeEntity.start_id <= end_id + 1,
+            SyncedRangeEntity.end_id >= start_id - 1,
+        )
+    ).all()
+    if neighbours:
+        start_id = min(start_id, *(row.start_id for row in neighbours))
+        end_id = max(end_id, *(row.end_id for row in neighbours))
+        session.execute(
+            delete(SyncedRangeEntity)
+            .where(
+                SyncedRangeEntity.chat_id == chat_id,
+                SyncedRangeEntity.start_id.in_([row.start_id for row in neighbours]),
+            )
+        )
+    session.execute(insert(SyncedRangeEntity).values(chat_id=chat_id, start_id=start_id, end_id=end_id))
+
+
+def get_ranges(chat_id):
+    with session_generator() as session:
+        rows = session.execute(
+            select(SyncedRangeEntity.start_id, SyncedRangeEntity.end_id)
+            .where(SyncedRangeEntity.chat_id == chat_id)
+            .order_by(SyncedRangeEntity.start_id)
+        ).all()
+    return [(row.start_id, row.end_id) for row in rows]
+
+
+def uncovered(ranges, low, high=0):
+    '''
+    Gaps of [low, high] not covered by the sorted ranges. With high 0
+    the last gap is (start, 0), everything above the last range.
+    '''
+    gaps = []
+    next_id = low
+    for start_id, end_id in ranges:
+        if high and start_id > high:
+            break
+        if end_id < next_id:
+            continue
+        if start_id > next_id:
+            gaps.append((next_id, start_id - 1))
+        next_id = end_id + 1
+
+    if not high:
+        gaps.append((next_id, 0))
+    elif next_id <= high:
+        gaps.append((next_id, high))
+    return gaps
+
+
+def synced_through(chat_id):
+    '''
+    return the id up to which every message of chat_id, from the start of
+    its configured range, is synced, 0 when the start itself is missing
+    '''
+    ranges = get_ranges(chat_id)
+    min_id = config['tg']['chats'].get(str(chat_id), {}).get('range', [0, 0])[0]
+    if not ranges or ranges[0][0] > max(min_id, 1):
+        return 0
+    return ranges[0][1]
+
+
+def format_ranges(ranges, limit=5):
+    parts = [f'{start_id}-{end_id or ""}' for start_id, end_id in ranges[:limit]]
+    if limit and len(ranges) > limit:
+        parts.append(f'... {len(ranges) - limit} more')
+    return ', '.join(parts) or '-'
+
+
+def coverage(chat_id):
+    '''
+    return (synced ranges, gaps between the start of the configured range and the last synced id, stored messages)
+    '''
+    ranges = get_ranges(chat_id)
+    with session_generator() as session:
+        message_count = session.scalar(select(ChatStateEntity.message_count).where(ChatStateEntity.chat_id == chat_id))
+
+    min_id = config['tg']['chats'].get(str(chat_id), {}).get('range', [0, 0])[0]
+    gaps = uncovered(ranges, max(min_id, 1), ranges[-1][1]) if ranges else []
+    return ranges, gaps, message_count or 0
+
+
+def add_parser(subparsers):
+    parser = subparsers.add_parser('coverage', help='Show the synced message ids and the gaps of each chat')
+    parser.add_argument('-c', '--chat', type=int, action='append', help='Chat to show, may be repeated, all configured chats by default')
+    parser.add_argument('-a', '--all', action='store_true', help='List every range and gap instead of the first few')
+    return parser
+
+
+def main(args):
+    chat_ids = args.chat or [int(chat_id) for chat_id in config['tg']['chats']]
+    limit = None if args.all else 5
+
+    rows = []
+    for chat_id in chat_ids:
+        ranges, gaps, message_count = coverage(chat_id)
+        rows.append([
+            chat_id,
+            message_count,
+            sum(end_id - start_id + 1 for start_id, end_id in ranges),
+            format_ranges(ranges, limit),
+            sum(end_id - start_id + 1 for start_id, end_id in gaps),
+            format_ranges(gaps, limit),
+        ])
+    print(tabulate(rows, headers=['chat', 'messages', 'synced ids', 'synced ranges', 'missing ids', 'gaps']))
+
+    if any(row[4] for row in rows):
+        logger.info('Gaps are fetched on the next sync of their chat')
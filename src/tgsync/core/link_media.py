@@ -1,9 +1,13 @@
 import re
 import os
+from functools import lru_cache
 from mimetypes import guess_extension
 
+from sqlalchemy import select, update, or_, tuple_
+
 from tgsync.config import config
 from tgsync.logger import logger
+from tgsync.metrics import LINKS
 from tgsync.db.session import session_generator
 from tgsync.db.entities import MessageEntity, PhotoEntity, DocumentEntity
 
@@ -29,80 +33,140 @@ def make_safe_filename(name):
     return safe_name
 
 
-def link_media():
-    with session_generator() as session:
-        candidates = (
-            session.query(
-                MessageEntity,
-                PhotoEntity.id.label('photo_id'),
-            )
-            .join(PhotoEntity, MessageEntity.photo_id == PhotoEntity.id)
-            .filter(
-                MessageEntity.linked == False,
-                PhotoEntity.saved == True
-            )
-        ).all()
-
-        for msg, photo_id in candidates:
-            chat_dir = config['download']['media'] / str(msg.chat_id)
-            chat_dir.mkdir(parents=True, exist_ok=True)
+@lru_cache(maxsize=None)
+def document_ext(mime_type):
+    ext = guess_extension(mime_type) if mime_type else None
+    if ext is None:
+        ext = '.bin'
+    return ext
 
-            dst = chat_dir / f'{msg.id:010d}_{photo_id}.jpg'
-
-            logger.debug(f'Linking {photo_id} to {dst}')
-            if os.path.exists(config['download']['media'] / 'photos-by-id' / f'{photo_id}.jpg'):
-                if not os.path.exists(dst):
-                    os.link(config['download']['media'] / 'photos-by-id' / f'{photo_id}.jpg', dst)
-                else:
-                    logger.warning(f'File {dst} already exists, skipping...')
-            else:
-                logger.warning(f'Previous saved photo {photo_id} is removed, skipping {msg.chat_id}/{msg.id}')
-
-            msg.linked = True
-
-    with session_generator() as session:
-        candidates = (
-            session.query(
-                MessageEntity,
-                DocumentEntity.id.label('document_id'),
-                DocumentEntity.name.label('document_name'),
-                DocumentEntity.type.label('document_type')
-            )
-            .join(DocumentEntity, MessageEntity.document_id == DocumentEntity.id)
-            .filter(
-                MessageEntity.linked == False,
-                DocumentEntity.saved == True
-            )
-        ).all()
-
-        for msg, document_id, document_name, document_type in candidates:
-            chat_dir = config['download']['media'] / str(msg.chat_id)
-            chat_dir.mkdir(parents=True, exist_ok=True)
 
-            ext = guess_extension(document_type)
-            if ext is None:
-                ext = '.bin'
-            src = config['download']['media'] / 'documents-by-id' / f'{document_id}{ext}'
+class ChatDirs:
+    '''
+    Chat dirs created once per process. Existing names are not listed,
+    os.link itself fails on a taken name, so linking a batch costs one
+    syscall per candidate however large the chat dir has grown.
+    '''
 
-            filename = f'{msg.id:010d}'
-            if document_name:
-                filename += f' {document_name}'
-            else:
-                filename += ext
-            filename = make_safe_filename(filename)
-            dst = chat_dir / filename
+    def __init__(self):
+        self.created = set()
 
-            logger.debug(f'Linking {src} to {dst}')
-            if os.path.exists(src):
-                if not os.path.exists(dst):
-                    os.link(src, dst)
-                else:
-                    logger.warning(f'File {dst} already exists, skipping...')
-            else:
-                logger.warning(f'Previous saved document {document_id} is removed, skipping {msg.chat_id}/{msg.id}')
-
-            msg.linked = True
+    def get(self, chat_id):
+        chat_dir = config['download']['media'] / str(chat_id)
+        if chat_id not in self.created:
+            chat_dir.mkdir(parents=True, exist_ok=True)
+            self.created.add(chat_id)
+        return chat_dir
+
+
+chat_dirs = ChatDirs()
+
+
+def repo_path(photo_id=None, document_id=None, document_type=None, root=None):
+    '''
+    return the path of a media in the repo under root, the media dir by default
+    '''
+    root = root or config['download']['media']
+    if photo_id is not None:
+        return root / 'photos-by-id' / f'{photo_id}.jpg'
+    return root / 'documents-by-id' / f'{document_id}{document_ext(document_type)}'
+
+
+def link_paths(msg_id, photo_id, document_id, document_name, document_type):
+    '''
+    return the file in the media repo and the name of its link in the chat dir
+    '''
+    src = repo_path(photo_id, document_id, document_type)
+    if photo_id is not None:
+        return src, f'{msg_id:010d}_{photo_id}.jpg'
+
+    ext = document_ext(document_type)
+    filename = f'{msg_id:010d}'
+    if document_name:
+        filename += f' {document_name}'
+    else:
+        filename += ext
+    return src, make_safe_filename(filename)
+
+
+def get_candidates(session, chat_id, after, limit):
+    stmt = (
+        select(
+            MessageEntity.chat_id,
+            MessageEntity.id,
+            PhotoEntity.id.label('photo_id'),
+            DocumentEntity.id.label('document_id'),
+            DocumentEntity.name.label('document_name'),
+            DocumentEntity.type.label('document_type'),
+        )
+        .outerjoin(PhotoEntity, MessageEntity.photo_id == PhotoEntity.id)
+        .outerjoin(DocumentEntity, MessageEntity.document_id == DocumentEntity.id)
+        .where(
+            MessageEntity.linked == False,
+            or_(PhotoEntity.saved == True, DocumentEntity.saved == True),
+            tuple_(MessageEntity.chat_id, MessageEntity.id) > tuple_(*after),
+        )
+        .order_by(MessageEntity.chat_id, MessageEntity.id)
+        .limit(limit)
+    )
+    if chat_id is not None:
+        stmt = stmt.where(MessageEntity.chat_id == chat_id)
+    return session.execute(stmt).all()
+
+
+def link_media(chat_id=None):
+    '''
+    Hard link saved media of unlinked messages into their chat dirs,
+    all chats unless chat_id is given.
+
+    Candidates are read and marked linked in batches of
+    `download.link_batch`, each batch in its own transaction.
+    '''
+    batch_size = config['download'].get('link_batch', 1000)
+    after = (-2**63, -2**63)
+    linked = 0
+
+    while True:
+        with session_generator() as session:
+            candidates = get_candidates(session, chat_id, after, batch_size)
+            if not candidates:
+                break
+
+            done = {}
+            for row in candidates:
+                chat_dir = chat_dirs.get(row.chat_id)
+                src, name = link_paths(row.id, row.photo_id, row.document_id, row.document_name, row.document_type)
+
+                logger.debug(f'Linking {src} to {chat_dir / name}')
+                try:
+                    os.link(src, chat_dir / name)
+                except FileExistsError:
+                    logger.warning(f'File {chat_dir / name} already exists, skipping...')
+                except FileNotFoundError:
+                    if os.path.exists(src):
+                        # The chat dir was removed since it was created.
+                        chat_dirs.created.discard(row.chat_id)
+                        os.link(src, chat_dirs.get(row.chat_id) / name)
+                    else:
+                        logger.warning(f'Previous saved media {src.name} is removed, skipping {row.chat_id}/{row.id}')
+
+                done.setdefault(row.chat_id, []).append(row.id)
+
+            for done_chat_id, msg_ids in done.items():
+                session.execute(
+                    update(MessageEntity)
+                    .where(MessageEntity.chat_id == done_chat_id, MessageEntity.id.in_(msg_ids))
+                    .values(linked=True)
+                )
+
+        linked += len(candidates)
+        LINKS.inc(len(candidates))
+        after = (candidates[-1].chat_id, candidates[-1].id)
+
+    logger.info(f'Linked {linked} messages' + (f' of {chat_id}' if chat_id is not None else ''))
+    return linked
 
 
 if __name__ == '__main__':
-    link_media()
+    from sys import argv
+    link_media(int(argv[1]) if len(argv) > 1 else None)
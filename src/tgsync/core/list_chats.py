@@ -4,15 +4,16 @@ from tgsync.config import appdata
 from tgsync.logger import logger
 
 
-async def list_chats(client):
+async def list_chats(client, save=True):
     chats = {}
     async for dialog in client.iter_dialogs():
         chats[dialog.name] = str(dialog.id)
 
-    with open(appdata / 'chats.json', 'w') as f:
-        json.dump(chats, f, ensure_ascii=False, indent=2)
+    if save:
+        with open(appdata / 'chats.json', 'w') as f:
+            json.dump(chats, f, ensure_ascii=False, indent=2)
 
-    logger.info(f'Chats saved to {appdata / "chats.json"}.')
+        logger.info(f'Chats saved to {appdata / "chats.json"}.')
 
     return chats
 
@@ -0,0 +1,209 @@
+import asyncio
+import traceback
+
+from sqlalchemy import select
+from telethon import events
+from telethon.tl.types import Message
+
+from tgsync.config import config
+from tgsync.logger import logger
+from tgsync.core.sync_chat import msg_to_dicts, write_msgs
+from tgsync.core.reconcile import reconcile_chat
+from tgsync.core.scheduler import reconcile_window
+from tgsync.core.link_media import link_media
+from tgsync.core.download_queue import media_key
+from tgsync.core.media_job import MediaJob
+from tgsync.db.session import session_generator, run_db
+from tgsync.db.entities import PhotoEntity, DocumentEntity
+
+
+def write_live_msgs(pages):
+    '''
+    Live messages may arrive ahead of a gap that is not synced yet,
+    so they never advance the resume point of their chat.
+    '''
+    for page in pages:
+        write_msgs(*page, advance=False)
+
+
+def get_saved_media(photo_ids, document_ids):
+    with session_generator() as session:
+        saved = {
+            ('photo', media_id) for media_id in session.execute(
+                select(PhotoEntity.id).where(PhotoEntity.id.in_(photo_ids), PhotoEntity.saved == True)
+            ).scalars()
+        }
+        saved |= {
+            ('document', media_id) for media_id in session.execute(
+                select(DocumentEntity.id).where(DocumentEntity.id.in_(document_ids), DocumentEntity.saved == True)
+            ).scalars()
+        }
+    return saved
+
+
+class LiveSync:
+    '''
+    Ingests new messages of the configured chats as Telegram pushes them,
+    instead of polling every chat.
+
+    Incoming messages are written in batches every `live.flush_interval`
+    seconds and their media is queued on the scheduler's download service
+    right after. Chats with new media are linked every
+    `live.link_interval` seconds once their downloads are done. Messages
+    missed before the first event or while disconnected are fetched with
+    a full scheduler pass at startup and after every reconnect, and the
+    `reconcile_window` of every chat is re-checked for edits and deletions
+    every `live.reconcile_interval` seconds.
+
+    Telethon stops reconnecting on its own after a few attempts, a client
+    found disconnected is then reconnected here with backoff. After
+    `live.reconnect_attempts` failures run() raises, so the process exits
+    and is restarted instead of idling disconnected.
+
+    Only the primary client of the pool listens for new messages.
+    '''
+
+    def __init__(self, pool, scheduler):
+        self.pool = pool
+        self.client = pool.primary
+        self.scheduler = scheduler
+        self.download_service = scheduler.download_service
+        self.flush_interval = config.get('live', {}).get('flush_interval', 1)
+        self.link_interval = config.get('live', {}).get('link_interval', 10)
+        self.reconcile_interval = config.get('live', {}).get('reconcile_interval', 3600)
+        self.reconnect_attempts = config.get('live', {}).get('reconnect_attempts', 10)
+        self.chats = {int(chat_id): chat_config for chat_id, chat_config in config['tg']['chats'].items()}
+        self.pending = []
+        self.unlinked = set()
+
+
+    async def on_new_message(self, event):
+        msg = event.message
+        if type(msg) is not Message:
+            return
+
+        chat_config = self.chats[msg.chat_id]
+        if 'range' in chat_config and chat_config['range'][1] and msg.id > chat_config['range'][1]:
+            return
+
+        self.pending.append(msg)
+
+
+    async def flush(self):
+        msgs, self.pending = self.pending, []
+        if not msgs:
+            return
+
+        by_chat = {}
+        for msg in msgs:
+            by_chat.setdefault(msg.chat_id, ([], [], []))
+            msg_to_dicts(msg, *by_chat[msg.chat_id])
+        try:
+            await run_db(write_live_msgs, by_chat.values())
+        except BaseException:
+            self.pending[:0] = msgs
+            raise
+        logger.info(f'Ingested {len(msgs)} new messages')
+
+        saved = await run_db(
+            get_saved_media,
+            [d['id'] for _, photo_dicts, _ in by_chat.values() for d in photo_dicts],
+            [d['id'] for _, _, document_dicts in by_chat.values() for d in document_dicts]
+        )
+        for msg in msgs:
+            if not (msg.photo or msg.document) or not self.chats[msg.chat_id].get('media', True):
+                continue
+            job = MediaJob.from_message(msg)
+            if media_key(job) not in saved:
+                await self.download_service.queue.put(msg.chat_id, job)
+            self.unlinked.add(msg.chat_id)
+
+
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.error(f'Failed to ingest new messages: {traceback.format_exc()}')
+
+
+    async def link_loop(self):
+        while True:
+            await asyncio.sleep(self.link_interval)
+            if not self.unlinked:
+                continue
+
+            chats, self.unlinked = self.unlinked, set()
+            for chat_id in chats:
+                try:
+                    await self.download_service.join(chat_id)
+                    await run_db(link_media, chat_id)
+                except Exception:
+                    self.unlinked.add(chat_id)
+                    logger.error(f'Failed to link new media of {chat_id}: {traceback.format_exc()}')
+
+
+    async def reconcile_loop(self):
+        while True:
+            await asyncio.sleep(self.reconcile_interval)
+            for chat_id in self.chats:
+                window = reconcile_window(chat_id)
+                if window <= 0:
+                    continue
+                try:
+                    await self.pool.run(chat_id, reconcile_chat, chat_id, window)
+                except Exception:
+                    logger.error(f'Failed to reconcile {chat_id}: {traceback.format_exc()}')
+
+
+    async def fill_gaps(self):
+        logger.info('Reconnected, filling gaps...')
+        await self.scheduler.run()
+
+
+    async def reconnect(self):
+        delay = 5
+        for attempt in range(1, self.reconnect_attempts + 1):
+            try:
+                await self.client.connect()
+            except (OSError, asyncio.TimeoutError) as e:
+                logger.warning(f'Reconnect attempt {attempt}/{self.reconnect_attempts} failed: {e!r}')
+            if self.client.is_connected():
+                return
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 300)
+        raise ConnectionError(f'Could not reconnect to Telegram after {self.reconnect_attempts} attempts')
+
+
+    async def watch_connection(self):
+        while True:
+            await asyncio.sleep(5)
+            if not self.client.is_connected():
+                logger.warning('Disconnected from Telegram, reconnecting...')
+                await self.reconnect()
+                await self.fill_gaps()
+
+
+    async def run(self):
+        handler = events.NewMessage(chats=list(self.chats))
+        self.client.add_event_handler(self.on_new_message, handler)
+        logger.info(f'Listening for new messages in {len(self.chats)} chats')
+
+        tasks = [
+            asyncio.create_task(self.flush_loop()),
+            asyncio.create_task(self.link_loop()),
+            asyncio.create_task(self.watch_connection()),
+        ]
+        if self.reconcile_interval > 0:
+            tasks.append(asyncio.create_task(self.reconcile_loop()))
+        try:
+            await self.scheduler.run()
+            logger.info('All chats caught up, running in live mode.')
+            await asyncio.gather(*tasks)
+        finally:
+            self.client.remove_event_handler(self.on_new_message, handler)
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.flush()
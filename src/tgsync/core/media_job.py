@@ -0,0 +1,141 @@
+from telethon.tl.types import (
+    PhotoSize, PhotoSizeProgressive,
+    InputPhotoFileLocation, InputDocumentFileLocation,
+)
+
+from tgsync.db.entities import PhotoEntity, DocumentEntity
+
+
+def largest_photo_size(photo):
+    '''
+    return (type, size) of the largest downloadable size of photo,
+    (None, None) when only inline sizes are available
+    '''
+    best_type, best_size = None, None
+    for size in photo.sizes:
+        if isinstance(size, PhotoSize):
+            length = size.size
+        elif isinstance(size, PhotoSizeProgressive):
+            length = max(size.sizes)
+        else:
+            continue
+        if best_size is None or length > best_size:
+            best_type, best_size = size.type, length
+    return best_type, best_size
+
+
+def photo_location_dict(photo):
+    thumb_size, size = largest_photo_size(photo)
+    return {
+        'access_hash'    : photo.access_hash,
+        'file_reference' : photo.file_reference,
+        'dc_id'          : photo.dc_id,
+        'thumb_size'     : thumb_size,
+        'size'           : size,
+    }
+
+
+def document_location_dict(document):
+    return {
+        'access_hash'    : document.access_hash,
+        'file_reference' : document.file_reference,
+        'dc_id'          : document.dc_id,
+    }
+
+
+class MediaJob:
+    '''
+    One photo or document to download, located either from the columns
+    stored by sync_msgs or, when those are missing, from a fetched message.
+    '''
+
+    def __init__(self, chat_id, msg_id, photo_id=None, document_id=None,
+                 size=0, name=None, mime_type=None, location=None, dc_id=None, msg=None):
+        self.chat_id = chat_id
+        self.msg_id = msg_id
+        self.photo_id = photo_id
+        self.document_id = document_id
+        self.size = size or 0
+        self.name = name
+        self.mime_type = mime_type
+        self.location = location
+        self.dc_id = dc_id
+        self.msg = msg
+
+
+    @property
+    def is_photo(self):
+        return self.photo_id is not None
+
+
+    @property
+    def media_id(self):
+        return self.photo_id if self.is_photo else self.document_id
+
+
+    @property
+    def entity_class(self):
+        return PhotoEntity if self.is_photo else DocumentEntity
+
+
+    def __str__(self):
+        if self.is_photo:
+            return f'photo: {self.chat_id}/{self.msg_id} | {self.photo_id}'
+        return f'document: {self.chat_id}/{self.msg_id} | {self.document_id} | {self.name}'
+
+
+    @classmethod
+    def from_entity(cls, chat_id, msg_id, entity):
+        '''
+        return the job of a PhotoEntity or DocumentEntity,
+        None if its location was never stored
+        '''
+        if entity.access_hash is None:
+            return None
+
+        if isinstance(entity, PhotoEntity):
+            if entity.thumb_size is None:
+                return None
+            location = InputPhotoFileLocation(
+                id=entity.id,
+                access_hash=entity.access_hash,
+                file_reference=entity.file_reference,
+                thumb_size=entity.thumb_size,
+            )
+            return cls(chat_id, msg_id, photo_id=entity.id, size=entity.size,
+                       location=location, dc_id=entity.dc_id)
+
+        location = InputDocumentFileLocation(
+            id=entity.id,
+            access_hash=entity.access_hash,
+            file_reference=entity.file_reference,
+            thumb_size='',
+        )
+        return cls(chat_id, msg_id, document_id=entity.id, size=entity.size, name=entity.name,
+                   mime_type=entity.type, location=location, dc_id=entity.dc_id)
+
+
+    @classmethod
+    def from_message(cls, msg):
+        if msg.photo:
+            thumb_size, size = largest_photo_size(msg.photo)
+            location = None
+            if thumb_size is not None:
+                location = InputPhotoFileLocation(
+                    id=msg.photo.id,
+                    access_hash=msg.photo.access_hash,
+                    file_reference=msg.photo.file_reference,
+                    thumb_size=thumb_size,
+                )
+            return cls(msg.chat_id, msg.id, photo_id=msg.photo.id, size=size,
+                       location=location, dc_id=msg.photo.dc_id, msg=msg)
+
+        return cls(msg.chat_id, msg.id, document_id=msg.document.id, size=msg.document.size,
+                   name=msg.file.name, mime_type=msg.document.mime_type,
+                   location=InputDocumentFileLocation(
+                       id=msg.document.id,
+                       access_hash=msg.document.access_hash,
+                       file_reference=msg.document.file_reference,
+                       thumb_size='',
+                   ),
+                   dc_id=msg.document.dc_id, msg=msg)
@@ -0,0 +1,152 @@
+import os
+import json
+from time import time
+
+from tgsync.config import config
+from tgsync.logger import logger
+from tgsync.core.content_hash import BLOCK_SIZE
+
+
+# Not .json, documents of that type have tempfiles named `<id>.json`.
+JOURNAL_SUFFIX = '.journal'
+
+class PartialJournal:
+    '''
+    Sidecar `<tempfile>.journal` of an incomplete download, recording for
+    every byte range [start, end) of the tempfile how many bytes from
+    start are known to be on disk, so the next attempt can continue there,
+    along with the digests of the blocks hashed so far.
+
+    With `download.resume_attempts` set to 0 nothing is written and
+    every download starts from scratch.
+    '''
+
+    def __init__(self, tempfile, size, parts, attempts=0, blocks=None):
+        self.tempfile = tempfile
+        self.path = tempfile.with_name(tempfile.name + JOURNAL_SUFFIX)
+        self.size = size
+        self.parts = parts
+        self.attempts = attempts
+        self.blocks = blocks or {}
+        self.resumable = config['download'].get('resume_attempts', 5) > 0
+
+
+    @property
+    def received(self):
+        return sum(done for _, _, done in self.parts)
+
+
+    @classmethod
+    def load(cls, tempfile, size):
+        journal = cls(tempfile, size, [])
+        if not (journal.resumable and os.path.exists(journal.path) and os.path.exists(tempfile)):
+            return None
+
+        try:
+            with open(journal.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            logger.warning(f'Unreadable journal {journal.path}, discarding partial download')
+            return None
+
+        if data['size'] != size or os.path.getsize(tempfile) != size:
+            logger.warning(f'Size of {tempfile} changed, discarding partial download')
+            return None
+        if data['attempts'] >= config['download'].get('resume_attempts', 5):
+            logger.warning(f'{tempfile} resumed {data["attempts"]} times, restarting download')
+            return None
+
+        journal.parts = data['parts']
+        journal.attempts = data['attempts']
+        journal.blocks = {int(i): digest for i, digest in data.get('blocks', {}).items()}
+        journal.rewind()
+        return journal
+
+
+    def rewind(self):
+        '''
+        Move every unfinished range back to the start of its current block,
+        a block only half written when the download stopped was never
+        hashed and is fetched again from its start.
+        '''
+        for part in self.parts:
+            start, end, done = part
+            if start + done < end:
+                part[2] = done - done % BLOCK_SIZE
+
+
+    @classmethod
+    def open(cls, tempfile, size, ranges):
+        '''
+        Resume the journal of tempfile if it is still usable,
+        otherwise preallocate tempfile and start over with `ranges`.
+        '''
+        journal = cls.load(tempfile, size)
+        if journal:
+            logger.info(f'Resuming {tempfile} at {journal.received}/{size} bytes')
+        else:
+            journal = cls(tempfile, size, [[start, end, 0] for start, end in ranges])
+            with open(tempfile, 'wb') as f:
+                if hasattr(os, 'posix_fallocate') and size > 0:
+                    os.posix_fallocate(f.fileno(), 0, size)
+                else:
+                    f.truncate(size)
+
+        journal.attempts += 1
+        journal.save()
+        return journal
+
+
+    def save(self):
+        if not self.resumable:
+            return
+        data = {'size': self.size, 'parts': self.parts, 'attempts': self.attempts, 'blocks': self.blocks}
+        temp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(temp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(temp_path, self.path)
+
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def clean_stale_partials(startup=False):
+    '''
+    Remove incomplete downloads not written to for `download.partial_ttl`
+    hours, and journals left without a tempfile. At startup, when nothing
+    is downloading, tempfiles without a journal are removed right away
+    as they cannot be resumed.
+    '''
+    deadline = time() - config['download'].get('partial_ttl', 72) * 3600
+
+    for directory in ('photos-by-id', 'documents-by-id'):
+        directory = config['download']['incomplete'] / directory
+        if not directory.exists():
+            continue
+
+        for path in directory.iterdir():
+            if path.suffix in (JOURNAL_SUFFIX, '.tmp'):
+                continue
+
+            journal = path.with_name(path.name + JOURNAL_SUFFIX)
+            try:
+                if os.path.exists(journal):
+                    touched = max(os.path.getmtime(path), os.path.getmtime(journal))
+                else:
+                    touched = 0 if startup else os.path.getmtime(path)
+            except FileNotFoundError:
+                # Finished and moved into the repo meanwhile.
+                continue
+            if touched >= deadline:
+                continue
+
+            logger.info(f'Removing stale partial download {path}')
+            os.remove(path)
+            if os.path.exists(journal):
+                os.remove(journal)
+
+        for path in directory.glob('*' + JOURNAL_SUFFIX):
+            if not path.with_suffix('').exists():
+                os.remove(path)
@@ -0,0 +1,129 @@
+import asyncio
+from time import monotonic
+from collections import defaultdict
+
+from tgsync.config import config
+from tgsync.logger import logger
+from tgsync.metrics import FLOOD_WAITS, FLOOD_WAIT_SECONDS, RATE_LIMIT_SECONDS, MESSAGE_LIMIT
+
+
+METHOD_CLASSES = {
+    'GetHistoryRequest': 'history',
+    'GetMessagesRequest': 'history',
+    'GetRepliesRequest': 'history',
+    'SearchRequest': 'history',
+    'GetFileRequest': 'download',
+    'GetCdnFileRequest': 'download',
+    'GetDialogsRequest': 'dialogs',
+    'GetPeerDialogsRequest': 'dialogs',
+    'SendMessageRequest': 'send',
+}
+
+DEFAULT_LIMITS = {
+    'history': {'rate': 3, 'burst': 10},
+    'dialogs': {'rate': 1, 'burst': 3},
+    'send': {'rate': 0.5, 'burst': 1},
+}
+
+MIN_MESSAGE_LIMIT = 100
+
+
+def method_class(request):
+    return METHOD_CLASSES.get(type(request).__name__, 'other')
+
+
+def message_limit(client):
+    '''
+    Page size for history of client, lowered while it is being flood waited.
+    '''
+    limiter = getattr(client, 'limiter', None)
+    return limiter.message_limit if limiter else config['tg']['message_limit']
+
+
+class TokenBucket:
+    '''
+    Holds `burst` tokens refilled at `rate` per second. Tokens are
+    reserved ahead, so concurrent callers queue up in call order.
+    '''
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+
+
+    def reserve(self):
+        '''
+        Take a token, return the seconds to wait before it may be used.
+        '''
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class RateLimiter:
+    '''
+    Request budget of one client, every API request waits here first.
+
+    Each method class in `tg.rate_limits` gets its own token bucket,
+    classes left out are not throttled. A flood wait pauses its own
+    class for the full wait and every other class for at most
+    `tg.flood_backoff` seconds, and halves the message_limit used
+    for history pages, which then grows back by one request per
+    successful history call.
+    '''
+
+    def __init__(self):
+        limits = config['tg'].get('rate_limits', DEFAULT_LIMITS)
+        self.buckets = {name: TokenBucket(limit['rate'], limit['burst']) for name, limit in limits.items()}
+        self.paused_until = defaultdict(float)
+        self.global_backoff = config['tg'].get('flood_backoff', 5)
+        self.max_message_limit = config['tg']['message_limit']
+        self.message_limit = self.max_message_limit
+
+
+    async def acquire(self, name):
+        waited = 0
+        bucket = self.buckets.get(name)
+        if bucket and (delay := bucket.reserve()) > 0:
+            await asyncio.sleep(delay)
+            waited += delay
+
+        # Checked last, a flood wait may come in while waiting for a token.
+        while (delay := self.paused_for(name)) > 0:
+            await asyncio.sleep(delay)
+            waited += delay
+
+        if waited:
+            RATE_LIMIT_SECONDS.labels(name).inc(waited)
+
+
+    def paused_for(self, name):
+        '''
+        Seconds until requests of method class name, or of every class with None, may go out.
+        '''
+        return max(self.paused_until[name], self.paused_until[None]) - monotonic()
+
+
+    def success(self, name):
+        if name == 'history' and self.message_limit < self.max_message_limit:
+            self.message_limit = min(self.max_message_limit, self.message_limit + MIN_MESSAGE_LIMIT)
+            MESSAGE_LIMIT.set(self.message_limit)
+
+
+    def flood_wait(self, name, request, seconds):
+        FLOOD_WAITS.labels(request).inc()
+        FLOOD_WAIT_SECONDS.labels(request).inc(seconds)
+
+        now = monotonic()
+        self.paused_until[name] = max(self.paused_until[name], now + seconds)
+        self.paused_until[None] = max(self.paused_until[None], now + min(seconds, self.global_backoff))
+
+        if name == 'history':
+            self.message_limit = max(MIN_MESSAGE_LIMIT, self.message_limit // 2)
+            MESSAGE_LIMIT.set(self.message_limit)
+        logger.warning(f'Flood wait of {seconds}s on {request}, pausing {name} requests'
+                       + (f', message_limit lowered to {self.message_limit}' if name == 'history' else ''))
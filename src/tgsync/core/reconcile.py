@@ -0,0 +1,127 @@
+from sqlalchemy import select, update, func
+
+from telethon.tl.types import Message
+
+from tgsync.logger import logger
+from tgsync.core.sync_chat import msg_to_dicts, utc_naive
+from tgsync.db.session import session_generator, run_db
+from tgsync.db.upsert import execute_insert
+from tgsync.db.entities import MessageEntity, PhotoEntity, DocumentEntity
+
+
+IDS_PER_REQUEST = 100
+
+
+def get_newest_id(chat_id):
+    with session_generator() as session:
+        return session.scalar(select(func.max(MessageEntity.id)).where(MessageEntity.chat_id == chat_id)) or 0
+
+
+def get_window(chat_id, min_id, max_id):
+    with session_generator() as session:
+        rows = session.execute(
+            select(
+                MessageEntity.id,
+                MessageEntity.edit_date,
+                MessageEntity.photo_id,
+                MessageEntity.document_id,
+                MessageEntity.linked,
+            )
+            .where(
+                MessageEntity.chat_id == chat_id,
+                MessageEntity.id.between(min_id, max_id),
+                MessageEntity.deleted == False,
+            )
+            .order_by(MessageEntity.id)
+        ).all()
+    return {row.id: row for row in rows}
+
+
+def write_reconciled(chat_id, msg_dicts, photo_dicts, document_dicts, deleted_ids):
+    with session_generator() as session:
+        if len(photo_dicts) > 0:
+            execute_insert(session, PhotoEntity, photo_dicts,
+                           lambda stmt: stmt.on_conflict_do_nothing(index_elements=['id']))
+        if len(document_dicts) > 0:
+            execute_insert(session, DocumentEntity, document_dicts,
+                           lambda stmt: stmt.on_conflict_do_nothing(index_elements=['id']))
+        if len(msg_dicts) > 0:
+            execute_insert(
+                session, MessageEntity, msg_dicts,
+                lambda stmt: stmt.on_conflict_do_update(
+                    index_elements=['id', 'chat_id'],
+                    set_={
+                        column: stmt.excluded[column]
+                        for column in msg_dicts[0] if column not in ('id', 'chat_id')
+                    }
+                ),
+            )
+        if len(deleted_ids) > 0:
+            session.execute(
+                update(MessageEntity)
+                .where(MessageEntity.chat_id == chat_id, MessageEntity.id.in_(deleted_ids))
+                .values(deleted=True)
+            )
+
+
+async def reconcile_chat(client, chat_id, window):
+    '''
+    Re-check the newest `window` stored messages of chat_id, including the
+    ones written by live mode ahead of the resume point, upsert the ones
+    edited since they were synced and mark the ones gone as deleted.
+
+    return (api_calls, edited, deleted)
+    '''
+    top_id = await run_db(get_newest_id, chat_id)
+    if top_id == 0:
+        return 0, 0, 0
+
+    stored = await run_db(get_window, chat_id, max(1, top_id - window + 1), top_id)
+    ids = list(stored)
+
+    api_calls = 0
+    msg_dicts, photo_dicts, document_dicts = [], [], []
+    deleted_ids = []
+    for i in range(0, len(ids), IDS_PER_REQUEST):
+        chunk = ids[i:i+IDS_PER_REQUEST]
+        msgs = await client.get_messages(chat_id, ids=chunk)
+        api_calls += 1
+
+        for msg_id, msg in zip(chunk, msgs):
+            if msg is None:
+                deleted_ids.append(msg_id)
+                continue
+            if type(msg) is not Message:
+                continue
+
+            row = stored[msg_id]
+            if utc_naive(msg.edit_date) == row.edit_date:
+                continue
+
+            msg_to_dicts(msg, msg_dicts, photo_dicts, document_dicts)
+            changed = msg_dicts[-1]
+            changed['linked'] = (
+                row.linked
+                and changed['photo_id'] == row.photo_id
+                and changed['document_id'] == row.document_id
+            )
+
+    if msg_dicts or deleted_ids:
+        await run_db(write_reconciled, chat_id, msg_dicts, photo_dicts, document_dicts, deleted_ids)
+
+    logger.info(f'Reconciled {len(ids)} recent messages of {chat_id}: '
+                f'{api_calls} API calls, {len(msg_dicts)} edited, {len(deleted_ids)} deleted')
+    return api_calls, len(msg_dicts), len(deleted_ids)
+
+
+async def main():
+    from tgsync.core.get_client import get_client
+    from sys import argv
+    client = await get_client()
+
+    await reconcile_chat(client, int(argv[1]), int(argv[2]))
+
+
+if __name__ == '__main__':
+    import asyncio
+    asyncio.run(main())
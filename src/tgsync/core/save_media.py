@@ -3,51 +3,82 @@ import shutil
 import asyncio
 import traceback
 from time import time
-from mimetypes import guess_extension
 from tabulate import tabulate
 
-from sqlalchemy import select, bindparam
+from telethon.client.downloads import MAX_CHUNK_SIZE
+
+from telethon import TelegramClient
+from telethon.errors import FileReferenceExpiredError, FileReferenceInvalidError
+
+from sqlalchemy import select, update, func, tuple_, bindparam
 
 from tgsync.config import config
 from tgsync.logger import logger
+from tgsync.metrics import DOWNLOAD_BYTES, DC_BYTES, DOWNLOADS, DOWNLOAD_ERRORS, QUEUE_DEPTH, TIMEOUTS
 from tgsync.core.get_client import get_client
-from tgsync.db.session import session_generator
+from tgsync.core.client_pool import ClientPool
+from tgsync.core.partial import PartialJournal, clean_stale_partials
+from tgsync.core.download_queue import DownloadQueue
+from tgsync.core.concurrency import AdaptiveConcurrency
+from tgsync.core.warm_senders import WarmSenders
+from tgsync.core.media_job import MediaJob
+from tgsync.core.content_hash import BLOCK_SIZE, BlockHasher, content_hash, hash_bytes, hash_file
+from tgsync.core.link_media import repo_path
+from tgsync.db.session import session_generator, run_db
+from tgsync.db.completion import CompletionSink
 from tgsync.db.entities import MessageEntity, PhotoEntity, DocumentEntity
 
 
+FILE_REFERENCE_ERRORS = (FileReferenceExpiredError, FileReferenceInvalidError)
+RANGE_ALIGNMENT = BLOCK_SIZE
+JOURNAL_INTERVAL = 32 * 1024 * 1024
+CLEAN_INTERVAL = 3600
+
+
 class ProgressSummary:
     def __init__(self):
-        self.report_time = time()
         self.tasks = [{
             'chat_msg_id': None,
             'media_id': None,
+            'dc_id': None,
             'name': None,
             'total': 0,
             'received': 0,
-            'start_time': 0,
-            'speed': 0,
+            'resumed': 0,
+            'started': 0,
         } for _ in range(config['download']['concurrent'])]
 
-    def init_task(self, seq, msg):
-        self.tasks[seq]['chat_msg_id'] = f'{msg.chat_id}/{msg.id}'
-        if msg.photo:
-            self.tasks[seq]['media_id'] = msg.photo.id
-            return f'photo: {self.tasks[seq]["chat_msg_id"]} | {msg.photo.id}'
-        else:
-            self.tasks[seq]['media_id'] = msg.document.id
-            self.tasks[seq]['name'] = msg.file.name
-            self.tasks[seq]['total'] = msg.document.size
-            self.tasks[seq]['speed'] = 0
-            self.tasks[seq]['received'] = 0
-            self.tasks[seq]['started'] = time()
-            media_str = f'document: {self.tasks[seq]["chat_msg_id"]} | {msg.document.id} | {msg.file.name}'
-            return media_str
+    def init_task(self, seq, job):
+        self.tasks[seq]['chat_msg_id'] = f'{job.chat_id}/{job.msg_id}'
+        self.tasks[seq]['media_id'] = job.media_id
+        self.tasks[seq]['dc_id'] = job.dc_id
+        self.tasks[seq]['dc_bytes'] = DC_BYTES.labels(job.dc_id)
+        self.tasks[seq]['name'] = job.name
+        self.tasks[seq]['total'] = job.size
+        self.tasks[seq]['received'] = 0
+        self.tasks[seq]['resumed'] = 0
+        self.tasks[seq]['started'] = time()
+        return str(job)
+
+    def resume_task(self, seq, received):
+        self.tasks[seq]['received'] = received
+        self.tasks[seq]['resumed'] = received
 
     def make_progress_callback(self, seq):
-        def progress_callback(received):
-            self.tasks[seq]['received'] = received
-            self.tasks[seq]['speed'] = received / (time() - self.tasks[seq]['started'])
-            self.log_progress()
+        '''
+        Called on every chunk, so only records the bytes,
+        speeds are worked out by log_progress.
+
+        With rewound the download moved back to received, e.g. to refetch
+        half hashed blocks, and the byte counters are left alone.
+        '''
+        task = self.tasks[seq]
+        download_bytes = DOWNLOAD_BYTES.labels(seq)
+        def progress_callback(received, rewound=False):
+            if not rewound:
+                download_bytes.inc(received - task['received'])
+                task['dc_bytes'].inc(received - task['received'])
+            task['received'] = received
         return progress_callback
 
     def log_progress(self):
@@ -56,18 +87,19 @@ class ProgressSummary:
                 if b < 1024:
                     return f'{b:.2f}{unit}'
                 b /= 1024
-
-        if time() - self.report_time < config['download']['summary_interval']:
-            return
-        self.report_time = time()
+            return f'{b:.2f}TiB'
 
         task_table = []
         total_speed = 0
+        dc_speeds = {}
+        now = time()
         for i, task in enumerate(self.tasks):
             if task['chat_msg_id'] is None:
                 continue
 
-            total_speed += task['speed']
+            speed = (task['received'] - task['resumed']) / max(now - task['started'], 1e-6)
+            total_speed += speed
+            dc_speeds[task['dc_id']] = dc_speeds.get(task['dc_id'], 0) + speed
 
             name = task['name']
             if name and len(name) > 32:
@@ -75,178 +107,474 @@ class ProgressSummary:
 
             task_table.append([
                 f'#{i}',
+                f'DC{task["dc_id"]}',
                 task['chat_msg_id'],
                 task['media_id'],
                 name,
                 f'{format_bytes(task["received"])}/{format_bytes(task["total"])}',
-                f'{100*task["received"] / task["total"]:.1f}%',
-                f'{format_bytes(task["speed"])}/s',
+                f'{100*task["received"] / task["total"]:.1f}%' if task['total'] else '',
+                f'{format_bytes(speed)}/s',
             ])
 
-        task_table.append(['', 'Total:'] + ['']*4 +  [f'{format_bytes(total_speed)}/s'])
+        if not task_table:
+            return
+        active = len(task_table)
+        for dc_id, speed in sorted(dc_speeds.items(), key=lambda item: str(item[0])):
+            task_table.append(['', f'DC{dc_id}'] + ['']*5 + [f'{format_bytes(speed)}/s'])
+        task_table.append(['', f'Total ({active} active):'] + ['']*5 +  [f'{format_bytes(total_speed)}/s'])
 
         logger.info('\n'+tabulate(task_table))
 
+    async def run(self):
+        while True:
+            await asyncio.sleep(config['download']['summary_interval'])
+            self.log_progress()
 
-async def download_with_timeout(client, msg, file, progress_callback, timeout):
-    received = 0
 
-    iter_download = client.iter_download(msg.media)
-    with open(file, 'wb') as f:
-        while True:
-            try:
-                chunk = await asyncio.wait_for(anext(iter_download), timeout)
+def split_ranges(size, parts):
+    '''
+    Split [0, size) into at most `parts` ranges, every boundary aligned
+    to RANGE_ALIGNMENT, a whole hash block and a multiple of the request
+    size, so every GetFile request of a range is aligned as Telegram
+    requires and each range is hashed in whole blocks. Telethon only picks
+    its direct iterator when the offset is also a multiple of the chunk
+    count, otherwise its generic one issues the same aligned requests.
+    '''
+    if size == 0:
+        return [(0, 0)]
+    part_size = -(-size // parts)
+    part_size = -(-part_size // RANGE_ALIGNMENT) * RANGE_ALIGNMENT
+    return [(start, min(start + part_size, size)) for start in range(0, size, part_size)]
+
+
+async def download_range(client, job, file, part, on_chunk, timeout, journal):
+    '''
+    Fetch the rest of `part`, a [start, end, done] list advanced in place
+    as bytes are written and hashed into the journal's blocks, the journal
+    is saved every JOURNAL_INTERVAL bytes and whenever the download stops.
+    '''
+    start, end, done = part
+    if start + done >= end:
+        return
+
+    iter_download = client.iter_download(
+        job.location,
+        offset=start + done,
+        limit=-(-(end - start - done) // MAX_CHUNK_SIZE),
+        request_size=MAX_CHUNK_SIZE,
+        file_size=job.size,
+        dc_id=job.dc_id,
+    )
+    hasher = BlockHasher(start + done, journal.blocks)
+    with open(file, 'r+b') as f:
+        f.seek(start + done)
+        unsynced = 0
+        try:
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(anext(iter_download), timeout)
+                except StopAsyncIteration:
+                    hasher.close()
+                    return
+                except asyncio.TimeoutError:
+                    TIMEOUTS.labels('document').inc()
+                    logger.error(f'Timeout occurred while downloading {job.chat_id}/{job.msg_id} at {start + part[2]}.')
+                    raise
+
                 f.write(chunk)
-                received += len(chunk)
-                progress_callback(received)
-            except StopAsyncIteration:
-                return
-            except asyncio.TimeoutError:
-                logger.error(f'Timeout occurred while downloading {msg.chat_id}/{msg.id}.')
-                raise
+                hasher.update(chunk)
+                part[2] += len(chunk)
+                on_chunk(len(chunk))
+
+                unsynced += len(chunk)
+                if unsynced >= JOURNAL_INTERVAL:
+                    f.flush()
+                    os.fsync(f.fileno())
+                    journal.save()
+                    unsynced = 0
+        finally:
+            f.flush()
+            journal.save()
+
+
+async def download_with_timeout(client, job, file, progress_callback, timeout, journal):
+    '''
+    Download the document of job into the preallocated file,
+    fetching the ranges of the journal concurrently.
+
+    Ranges stopped by an earlier attempt in this process, e.g. on an expired
+    file reference or a failover to another client, restart at a block boundary.
+    '''
+    journal.rewind()
+    received = journal.received
+    progress_callback(received, rewound=True)
+    def on_chunk(length):
+        nonlocal received
+        received += length
+        progress_callback(received)
+
+    tasks = [
+        asyncio.create_task(download_range(client, job, file, part, on_chunk, timeout, journal))
+        for part in journal.parts
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def find_duplicate(entity_class, media_id, digest):
+    with session_generator() as session:
+        duplicate = session.execute(
+            select(entity_class)
+            .where(
+                entity_class.content_hash == digest,
+                entity_class.saved == True,
+                entity_class.id != media_id,
+            )
+            .limit(1)
+        ).scalar_one_or_none()
+
+    if duplicate is None:
+        return None
+    if entity_class is PhotoEntity:
+        return repo_path(photo_id=duplicate.id)
+    return repo_path(document_id=duplicate.id, document_type=duplicate.type)
+
+
+def replace_with_link(src, dst):
+    temp_link = dst.with_name(dst.name + '.link')
+    if os.path.lexists(temp_link):
+        os.remove(temp_link)
+    os.link(src, temp_link)
+    os.replace(temp_link, dst)
+
+
+async def store_media(entity_class, media_id, tempfile, file, digest):
+    '''
+    Move a finished download into the repo, or when the same content
+    is already stored, hard link that file instead of keeping a second copy.
+    '''
+    duplicate = await run_db(find_duplicate, entity_class, media_id, digest)
+    if duplicate and os.path.exists(duplicate):
+        replace_with_link(duplicate, file)
+        os.remove(tempfile)
+        logger.info(f'{file.name} has the same content as {duplicate.name}, linked')
+    else:
+        # A copy when incomplete and media are on different filesystems.
+        await asyncio.to_thread(shutil.move, tempfile, file)
+
+
+def write_location(entity_class, media_id, file_reference):
+    with session_generator() as session:
+        session.execute(
+            update(entity_class)
+            .where(entity_class.id == media_id)
+            .values(file_reference=file_reference)
+        )
+
+
+async def refresh_location(client, job):
+    '''
+    Fetch the message of job again for a fresh file reference,
+    storing it for the next run.
+    '''
+    msg = await client.get_messages(job.chat_id, ids=job.msg_id)
+    fresh = MediaJob.from_message(msg) if msg and (msg.photo or msg.document) else None
+    if fresh is None or fresh.media_id != job.media_id:
+        raise ValueError(f'{job} is no longer available')
 
+    job.location, job.dc_id, job.msg = fresh.location, fresh.dc_id, msg
+    if job.location is not None:
+        await run_db(write_location, job.entity_class, job.media_id, job.location.file_reference)
+    logger.info(f'Refreshed file reference of {job}')
 
-async def save_worker(seq, queue, progress_summary, client):
+
+async def fetch_photo(client, job):
+    if job.location is None:
+        if job.msg is None:
+            await refresh_location(client, job)
+        if job.location is None:
+            return await client.download_media(message=job.msg, file=bytes)
+    return await client.download_file(job.location, bytes, file_size=job.size or None, dc_id=job.dc_id)
+
+
+async def download_photo(client, job, timeout):
+    try:
+        try:
+            return await asyncio.wait_for(fetch_photo(client, job), timeout)
+        except FILE_REFERENCE_ERRORS:
+            await refresh_location(client, job)
+            return await asyncio.wait_for(fetch_photo(client, job), timeout)
+    except asyncio.TimeoutError:
+        TIMEOUTS.labels('photo').inc()
+        raise
+
+
+async def download_document(client, job, file, progress_callback, timeout, journal):
+    # Finished ranges stay finished in the journal,
+    # a retry only fetches what is left.
+    try:
+        await download_with_timeout(client, job, file, progress_callback, timeout, journal)
+    except FILE_REFERENCE_ERRORS:
+        await refresh_location(client, job)
+        await download_with_timeout(client, job, file, progress_callback, timeout, journal)
+
+
+async def save_worker(seq, queue, progress_summary, pool, completion_sink, concurrency):
     logger.debug(f'Worker {seq} started')
     progress_callback = progress_summary.make_progress_callback(seq)
 
     while True:
+        job = None
         tempfile = None
+        keep_partial = False
+        await concurrency.acquire()
         try:
-            logger.debug(f'Worker {seq} fetching next message, queue size: {queue.qsize()}')
-            msg = await queue.get()
-            if not msg:
-                continue
-            media_str = progress_summary.init_task(seq, msg)
+            logger.debug(f'Worker {seq} fetching next media, queue size: {queue.qsize()}')
+            job = await queue.get()
+            media_str = progress_summary.init_task(seq, job)
             logger.info(f'Worker {seq} starting download {media_str}')
 
-            if msg.photo:
-                tempfile = config['download']['incomplete'] / 'photos-by-id' / f'{msg.photo.id}.jpg'
-                file = config['download']['media'] / 'photos-by-id' / f'{msg.photo.id}.jpg'
+            if job.is_photo:
+                tempfile = repo_path(photo_id=job.photo_id, root=config['download']['incomplete'])
+                file = repo_path(photo_id=job.photo_id)
 
-                await asyncio.wait_for(
-                    client.download_media(message=msg, file=tempfile),
-                    timeout=config['download']['timeout']
-                )
+                data = await pool.run(job.chat_id, download_photo, job, config['download']['timeout'])
+                progress_callback(len(data))
 
-                shutil.move(tempfile, file)
+                with open(tempfile, 'wb') as f:
+                    f.write(data)
+                digest = hash_bytes(data)
 
-                with session_generator() as session:
-                    entity = session.get(PhotoEntity, msg.photo.id)
-                    entity.saved = True
+                await store_media(PhotoEntity, job.photo_id, tempfile, file, digest)
 
-            elif msg.document:
-                ext = guess_extension(msg.document.mime_type)
-                if ext is None:
-                    ext = '.bin'
-                tempfile = config['download']['incomplete'] / 'documents-by-id' / f'{msg.document.id}{ext}'
-                file = config['download']['media'] / 'documents-by-id' / f'{msg.document.id}{ext}'
+                await completion_sink.add(PhotoEntity, job.photo_id, digest)
+                DOWNLOADS.labels('photo').inc()
 
-                if not (msg.file.name and msg.file.name.endswith('apk')):
-                    await download_with_timeout(
-                        client, msg, tempfile,
+            else:
+                tempfile = repo_path(document_id=job.document_id, document_type=job.mime_type,
+                                     root=config['download']['incomplete'])
+                file = repo_path(document_id=job.document_id, document_type=job.mime_type)
+                digest = None
+
+                if not (job.name and job.name.endswith('apk')):
+                    parts = 1
+                    ranged = config['download'].get('ranged')
+                    if ranged and job.size >= ranged['threshold']:
+                        parts = ranged['parts']
+
+                    journal = PartialJournal.open(tempfile, job.size, split_ranges(job.size, parts))
+                    keep_partial = journal.resumable
+                    progress_summary.resume_task(seq, journal.received)
+
+                    await pool.run(
+                        job.chat_id, download_document,
+                        job, tempfile,
                         progress_callback,
-                        config['download']['timeout']
+                        config['download']['timeout'],
+                        journal
                     )
 
-                    shutil.move(tempfile, file)
-
-                with session_generator() as session:
-                    entity = session.get(DocumentEntity, msg.document.id)
-                    entity.saved = True
+                    digest = content_hash(journal.blocks, job.size) or await asyncio.to_thread(hash_file, tempfile)
+                    await store_media(DocumentEntity, job.document_id, tempfile, file, digest)
+                    journal.remove()
 
-            else:
-                raise ValueError('Message does not contain a photo or document')
+                await completion_sink.add(DocumentEntity, job.document_id, digest)
+                DOWNLOADS.labels('document').inc()
 
             logger.info(f'Worker {seq} download finished {media_str}')
 
         except Exception:
+            if job:
+                DOWNLOAD_ERRORS.labels('photo' if job.is_photo else 'document').inc()
             logger.error(f'Exception in worker {seq}: {traceback.format_exc()}')
 
         finally:
             progress_summary.tasks[seq]['chat_msg_id'] = None
-            if tempfile and os.path.exists(tempfile):
+            if tempfile and not keep_partial and os.path.exists(tempfile):
                 os.remove(tempfile)
-            queue.task_done()
+            if job:
+                await queue.task_done(job)
+            await concurrency.release()
+
+
+def get_pending(stmt, after):
+    '''
+    return [(msg_id, entity)] of the next page of unsaved media after (dc_id, msg_id),
+    msg_id negated when paging newest first
+    '''
+    with session_generator() as session:
+        rows = session.execute(stmt, {'after_dc': after[0], 'after_id': after[1]}).all()
+        session.expunge_all()
+        return [(msg_id, entity) for msg_id, entity in rows]
+
+
+async def clean_partials_periodically():
+    '''
+    The service runs for the whole process, partials left by failed
+    downloads are removed as they go stale rather than at the next start.
+    '''
+    while True:
+        await asyncio.sleep(CLEAN_INTERVAL)
+        try:
+            clean_stale_partials()
+        except OSError:
+            logger.error(f'Failed to clean stale partial downloads: {traceback.format_exc()}')
 
 
-async def save_all(client, chat_id, photo):
+def make_dirs():
+    clean_stale_partials(startup=True)
     (config['download']['incomplete'] / 'photos-by-id').mkdir(parents=True, exist_ok=True)
     (config['download']['incomplete'] / 'documents-by-id').mkdir(parents=True, exist_ok=True)
     (config['download']['media'] / 'photos-by-id').mkdir(parents=True, exist_ok=True)
     (config['download']['media'] / 'documents-by-id').mkdir(parents=True, exist_ok=True)
 
+
+class DownloadService:
+    '''
+    Long-lived pool of download workers fed by all chats through one
+    DownloadQueue, started once and kept running across sync passes.
+
+    One worker is started per `download.concurrent`, AdaptiveConcurrency
+    decides how many of them may download at a time.
+    '''
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.queue = DownloadQueue(config['download']['concurrent'] * 4)
+        self.progress_summary = ProgressSummary()
+        self.completion_sink = CompletionSink()
+        self.concurrency = AdaptiveConcurrency(self.queue)
+        self.warm_senders = WarmSenders(pool, self.queue)
+        self.workers = []
+        self.background = []
+
+
+    def start(self):
+        make_dirs()
+        self.completion_sink.start()
+        QUEUE_DEPTH.set_function(self.queue.qsize)
+        self.background = [
+            asyncio.create_task(self.progress_summary.run()),
+            asyncio.create_task(self.warm_senders.run()),
+            asyncio.create_task(clean_partials_periodically()),
+        ]
+        if self.concurrency.adaptive:
+            self.background.append(asyncio.create_task(self.concurrency.run()))
+        self.workers = [
+            asyncio.create_task(save_worker(i, self.queue, self.progress_summary, self.pool,
+                                            self.completion_sink, self.concurrency))
+            for i in range(config['download']['concurrent'])
+        ]
+
+
+    async def join(self, chat_id):
+        '''
+        Wait until everything queued for chat_id is downloaded and marked saved.
+        '''
+        await self.queue.join(chat_id)
+        await self.completion_sink.flush()
+
+
+    async def close(self):
+        tasks = self.workers + self.background
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.workers = []
+        self.background = []
+        await self.warm_senders.close()
+        await self.completion_sink.close()
+
+
+async def enqueue_pending(pool, chat_id, photo, queue, min_id=0, max_id=0, newest_first=False):
+    '''
+    Feed every unsaved photo or document of chat_id into queue, only those
+    of messages min_id to max_id when max_id is given, and within each DC
+    of the newest messages first with newest_first.
+    returns once the last one has been queued (not downloaded).
+    '''
     if photo:
-        logger.info(f'Downloading photos from {chat_id}')
+        logger.info(f'Queueing photos from {chat_id}')
         target_id = MessageEntity.photo_id
         target_entity = PhotoEntity
         target_col = PhotoEntity.id
         saved_col = PhotoEntity.saved
     else:
-        logger.info(f'Downloading documents from {chat_id}')
+        logger.info(f'Queueing documents from {chat_id}')
         target_id = MessageEntity.document_id
         target_entity = DocumentEntity
         target_col = DocumentEntity.id
         saved_col = DocumentEntity.saved
 
+    conditions = [MessageEntity.chat_id == chat_id, saved_col == False]
+    if max_id:
+        conditions.append(MessageEntity.id.between(min_id, max_id))
+
+    # First message of each media, media sent more than once is queued once.
     subq = (
         select(
-            MessageEntity.id,
+            func.min(MessageEntity.id).label('id'),
             target_id.label('media_id')
         )
         .join(target_entity, target_id == target_col)
-        .where(
-            MessageEntity.chat_id == chat_id,
-            saved_col == False
-        )
-        .order_by(target_id, MessageEntity.id)
-        .distinct(target_id)
+        .where(*conditions)
+        .group_by(target_id)
         .subquery()
     )
+    # Media of one DC is queued together, so downloads stay on warm connections.
+    dc_id = func.coalesce(target_entity.dc_id, 0)
+    msg_key = -subq.c.id if newest_first else subq.c.id
     stmt = (
-        select(subq.c.id, subq.c.media_id)
-        .where(subq.c.id > bindparam('min_id'))
-        .order_by(subq.c.id)
+        select(subq.c.id, target_entity)
+        .join(target_entity, subq.c.media_id == target_col)
+        .where(tuple_(dc_id, msg_key) > tuple_(bindparam('after_dc'), bindparam('after_id')))
+        .order_by(dc_id, msg_key)
         .limit(config['download']['concurrent'] * 4)
     )
 
-    queue = asyncio.Queue(maxsize=(config['download']['concurrent']) * 4)
-    progress_summary = ProgressSummary()
+    after = (0, -2**63 if newest_first else 0)
+    while True:
+        rows = await run_db(get_pending, stmt, after)
 
-    workers = [asyncio.create_task(save_worker(i, queue, progress_summary, client))
-               for i in range(config['download']['concurrent'])]
+        if not rows:
+            logger.info(f'All {"photos" if photo else "documents"} queued for {chat_id}')
+            break
 
+        jobs = [MediaJob.from_entity(chat_id, msg_id, entity) for msg_id, entity in rows]
 
-    try:
-        min_id = 0
-        while True:
-            with session_generator() as session:
-                msg_ids = session.execute(stmt, {'min_id': min_id}).scalars().all()
+        # Rows stored before locations were recorded still need their message.
+        missing = [msg_id for (msg_id, _), job in zip(rows, jobs) if job is None]
+        if missing:
+            msgs = await pool.run(chat_id, TelegramClient.get_messages, chat_id, ids=missing)
+            fetched = {msg.id: MediaJob.from_message(msg) for msg in msgs if msg and (msg.photo or msg.document)}
+            jobs = [job or fetched.get(msg_id) for (msg_id, _), job in zip(rows, jobs)]
 
-            if not msg_ids:
-                logger.info(f'All {"Photos" if photo else "Documents"} saved for {chat_id}')
-                break
+        for job in jobs:
+            if job:
+                await queue.put(chat_id, job)
 
-            msgs = await client.get_messages(
-                chat_id,
-                ids=msg_ids,
-                limit=config['download']['concurrent'] * 4
-            )
+        after = (rows[-1][1].dc_id or 0, -rows[-1][0] if newest_first else rows[-1][0])
 
-            for msg in msgs:
-                await queue.put(msg)
 
-            min_id = msg_ids[-1]
+async def save_all(client, chat_id, photo):
+    pool = ClientPool([client])
+    download_service = DownloadService(pool)
+    download_service.start()
 
-        await queue.join()
+    try:
+        await enqueue_pending(pool, chat_id, photo, download_service.queue)
+        await download_service.join(chat_id)
+        logger.info(f'All {"Photos" if photo else "Documents"} saved for {chat_id}')
 
     except Exception:
         logger.error(traceback.format_exc())
 
     finally:
-        for w in workers:
-            w.cancel()
-        await asyncio.gather(*workers, return_exceptions=True)
+        await download_service.close()
 
 
 async def main():
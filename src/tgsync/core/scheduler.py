@@ -0,0 +1,113 @@
+import asyncio
+import traceback
+
+from tgsync.config import config
+from tgsync.logger import logger
+from tgsync.core.sync_chat import sync_chat
+from tgsync.core.reconcile import reconcile_chat
+from tgsync.core.save_media import DownloadService, enqueue_pending
+from tgsync.core.download_queue import newest_first
+from tgsync.core.link_media import link_media
+from tgsync.db.session import run_db
+
+
+def reconcile_window(chat_id):
+    chat_config = config['tg']['chats'][str(chat_id)]
+    return chat_config.get('reconcile_window', config['tg'].get('reconcile_window', 0))
+
+
+class Scheduler:
+    '''
+    Runs one pass over all configured chats.
+
+    Message sync runs for up to `tg.concurrent_chats` chats at a time,
+    every synced chat then feeds its pending media into the download
+    service shared by all chats and all passes, so the download workers
+    never idle between chats or between the photo and document phases.
+    Each chat is synced by the healthiest client of the pool that can access it.
+
+    Chats synced by backfill queue the media of every partition as soon as
+    it is written, newest first, instead of after the whole backfill.
+    '''
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.sync_slots = asyncio.Semaphore(config['tg'].get('concurrent_chats', 1))
+        self.download_service = DownloadService(pool)
+        self.partition_enqueues = {}
+
+
+    def queue_partition(self, chat_id, start, end):
+        '''
+        Queue the media of a written backfill partition in the background,
+        after the partitions written before it, so the sync never waits
+        for room in the download queue.
+        '''
+        queue = self.download_service.queue
+        queue.set_priority(chat_id, newest_first(queue.priority_names))
+        previous = self.partition_enqueues.get(chat_id)
+        self.partition_enqueues[chat_id] = asyncio.create_task(self.enqueue_partition(chat_id, start, end, previous))
+
+
+    async def enqueue_partition(self, chat_id, start, end, previous):
+        if previous:
+            await previous
+        try:
+            for photo in (True, False):
+                await enqueue_pending(self.pool, chat_id, photo, self.download_service.queue, start, end, newest_first=True)
+        except Exception:
+            logger.error(f'Failed to queue media of {chat_id} from {start} to {end}: {traceback.format_exc()}')
+
+
+    async def sync(self, chat_id):
+        chat_config = config['tg']['chats'][chat_id]
+        on_partition = None
+        if chat_config.get('media', True):
+            on_partition = lambda start, end: self.queue_partition(int(chat_id), start, end)
+
+        min_id, max_id = 0, 0
+        if 'range' in chat_config:
+            min_id, max_id = chat_config['range']
+
+        async with self.sync_slots:
+            logger.info(f'Syncing messages of {chat_id}...')
+            await self.pool.run(int(chat_id), sync_chat, int(chat_id), min_id, max_id, on_partition=on_partition)
+            window = reconcile_window(chat_id)
+            if window > 0:
+                await self.pool.run(int(chat_id), reconcile_chat, int(chat_id), window)
+
+
+    async def process(self, chat_id):
+        try:
+            await self.sync(chat_id)
+
+            chat_config = config['tg']['chats'][chat_id]
+            if chat_config.get('media', True):
+                partitions = self.partition_enqueues.pop(int(chat_id), None)
+                if partitions:
+                    # Saved flags of the backfilled media have to be flushed
+                    # before the full scan, or it would queue them again.
+                    await partitions
+                    await self.download_service.join(int(chat_id))
+                await enqueue_pending(self.pool, int(chat_id), True, self.download_service.queue)
+                await enqueue_pending(self.pool, int(chat_id), False, self.download_service.queue)
+                await self.download_service.join(int(chat_id))
+
+            logger.info(f'Linking media of {chat_id} to chat dir...')
+            await run_db(link_media, int(chat_id))
+
+            logger.info(f'Chat {chat_id} completed.')
+
+        except Exception:
+            logger.error(f'Failed to process chat {chat_id}: {traceback.format_exc()}')
+
+
+    async def run(self):
+        if not self.download_service.workers:
+            self.download_service.start()
+
+        await asyncio.gather(*(self.process(chat_id) for chat_id in config['tg']['chats']))
+
+
+    async def close(self):
+        await self.download_service.close()
@@ -0,0 +1,106 @@
+import re
+from datetime import datetime
+
+from tabulate import tabulate
+from sqlalchemy import select, func, tuple_, literal_column, not_
+
+from tgsync.logger import logger
+from tgsync.db.session import session_generator, engine
+from tgsync.db.entities import MessageEntity, TS_CONFIG, message_tsvector
+
+
+TERMS = re.compile(r'(-?)"([^"]+)"|(-?)(\S+)')
+
+
+def like_terms(query):
+    '''
+    Conditions matching query on databases without full-text search:
+    every phrase and word must appear in the message, -excluded ones must not.
+    '''
+    conditions = []
+    for phrase_not, phrase, word_not, word in TERMS.findall(query):
+        term = phrase or word
+        if not phrase and term.lower() == 'or':
+            continue
+        pattern = '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        condition = MessageEntity.message.like(pattern, escape='\\')
+        conditions.append(not_(condition) if phrase_not or word_not else condition)
+    return conditions
+
+
+def search(query, chat_ids=None, sender_ids=None, since=None, until=None, deleted=False, after=None, limit=20):
+    '''
+    Messages matching query, in web search syntax: "quoted phrases", or, -excluded.
+
+    Newest first, `after` is the (date, chat_id, id) of the last message
+    of the previous page.
+
+    Without Postgres, words are matched as substrings with LIKE,
+    or is ignored and every term must match.
+    '''
+    columns = [MessageEntity.date, MessageEntity.chat_id, MessageEntity.id, MessageEntity.sender_id]
+    if engine.dialect.name == 'postgresql':
+        tsquery = func.websearch_to_tsquery(literal_column(f"'{TS_CONFIG}'::regconfig"), query)
+        snippet = func.ts_headline(literal_column(f"'{TS_CONFIG}'::regconfig"), MessageEntity.message, tsquery,
+                                   'MaxFragments=1, MaxWords=24, MinWords=8, StartSel=[, StopSel=]')
+        conditions = [message_tsvector().op('@@')(tsquery)]
+    else:
+        snippet = func.substr(MessageEntity.message, 1, 160)
+        conditions = like_terms(query)
+    stmt = (
+        select(*columns, snippet.label('snippet'))
+        .where(*conditions)
+        .order_by(MessageEntity.date.desc(), MessageEntity.chat_id.desc(), MessageEntity.id.desc())
+        .limit(limit)
+    )
+    if chat_ids:
+        stmt = stmt.where(MessageEntity.chat_id.in_(chat_ids))
+    if sender_ids:
+        stmt = stmt.where(MessageEntity.sender_id.in_(sender_ids))
+    if since:
+        stmt = stmt.where(MessageEntity.date >= since)
+    if until:
+        stmt = stmt.where(MessageEntity.date < until)
+    if not deleted:
+        stmt = stmt.where(MessageEntity.deleted.isnot(True))
+    if after:
+        stmt = stmt.where(tuple_(MessageEntity.date, MessageEntity.chat_id, MessageEntity.id) < tuple_(*after))
+
+    with session_generator() as session:
+        return session.execute(stmt).all()
+
+
+def format_cursor(row):
+    return f'{row.date.isoformat()},{row.chat_id},{row.id}'
+
+
+def parse_cursor(cursor):
+    date, chat_id, msg_id = cursor.rsplit(',', 2)
+    return datetime.fromisoformat(date), int(chat_id), int(msg_id)
+
+
+def add_parser(subparsers):
+    parser = subparsers.add_parser('search', help='Search synced messages')
+    parser.add_argument('query', help='Words to search, "quoted phrase", or, -excluded')
+    parser.add_argument('-c', '--chat', type=int, action='append', help='Only this chat, may be repeated')
+    parser.add_argument('-f', '--sender', type=int, action='append', help='Only from this sender, may be repeated')
+    parser.add_argument('--since', type=datetime.fromisoformat, help='Only messages from this date on')
+    parser.add_argument('--until', type=datetime.fromisoformat, help='Only messages before this date')
+    parser.add_argument('--deleted', action='store_true', help='Include messages deleted from Telegram')
+    parser.add_argument('-n', '--limit', type=int, default=20, help='Results per page')
+    parser.add_argument('--after', type=parse_cursor, help='Cursor printed at the end of the previous page')
+    return parser
+
+
+def main(args):
+    rows = search(args.query, args.chat, args.sender, args.since, args.until, args.deleted, args.after, args.limit)
+    if not rows:
+        logger.info('No messages found')
+        return
+
+    print(tabulate(
+        [(row.date, f'{row.chat_id}/{row.id}', row.sender_id, row.snippet) for row in rows],
+        headers=['date', 'chat/message', 'sender', 'message'],
+    ))
+    if len(rows) == args.limit:
+        print(f'\nNext page: --after {format_cursor(rows[-1])}')
@@ -1,13 +1,20 @@
-from sqlalchemy.sql.elements import BindParameter
+import asyncio
+from time import time
+from datetime import datetime, timezone
 
 from telethon.utils import get_peer_id
 from telethon.tl.types import Message
 
 from tgsync.config import config
 from tgsync.logger import logger
+from tgsync.metrics import MESSAGES
+from tgsync.core.rate_limit import message_limit
+from tgsync.core.media_job import photo_location_dict, document_location_dict
+from tgsync.core.ledger import add_range, get_ranges, uncovered, format_ranges
 from tgsync.db.entities import *
-from tgsync.db.session import session_generator
-from sqlalchemy.dialects.postgresql import insert
+from tgsync.db.session import session_generator, run_db
+from tgsync.db.upsert import insert, execute_insert
+from sqlalchemy import case
 
 def get_id(entity):
     if entity is None:
@@ -15,13 +22,23 @@ def get_id(entity):
     return get_peer_id(entity)
 
 
+def utc_naive(date):
+    '''
+    Dates are stored as UTC in timestamp columns without time zone, an aware
+    date would be converted to the server's TimeZone by Postgres first.
+    '''
+    if date is None or date.tzinfo is None:
+        return date
+    return date.astimezone(timezone.utc).replace(tzinfo=None)
+
+
 def msg_to_dicts(msg, msg_dicts, photo_dicts, document_dicts):
     msg_dict = {
         'id'        : msg.id,
         'chat_id'   : msg.chat_id,
         'sender_id' : msg.sender_id,
-        'date'      : msg.date,
-        'edit_date' : msg.edit_date,
+        'date'      : utc_naive(msg.date),
+        'edit_date' : utc_naive(msg.edit_date),
         'message'   : msg.text,
         'reply_to_msg_id'    : None,
         'reply_to_chat_id'   : None,
@@ -33,6 +50,7 @@ def msg_to_dicts(msg, msg_dicts, photo_dicts, document_dicts):
         'photo_id'    : None,
         'document_id' : None,
         'linked'      : False,
+        'deleted'     : False,
     }
 
     if msg.is_reply:
@@ -44,13 +62,14 @@ def msg_to_dicts(msg, msg_dicts, photo_dicts, document_dicts):
         msg_dict['fwd_from_msg_id']    = msg.forward.channel_post
         msg_dict['fwd_from_chat_id']   = msg.forward.chat_id
         msg_dict['fwd_from_sender_id'] = msg.forward.sender_id
-        msg_dict['fwd_from_date']      = msg.forward.date
+        msg_dict['fwd_from_date']      = utc_naive(msg.forward.date)
 
     if msg.photo:
         msg_dict['photo_id'] = msg.photo.id
         photo_dict = {
             'id'    : msg.photo.id,
             'saved' : False,
+            **photo_location_dict(msg.photo),
         }
         photo_dicts.append(photo_dict)
 
@@ -62,88 +81,345 @@ def msg_to_dicts(msg, msg_dicts, photo_dicts, document_dicts):
             'size'  : msg.document.size,
             'name'  : msg.file.name,
             'saved' : False,
+            **document_location_dict(msg.document),
         }
         document_dicts.append(doc_dict)
 
     msg_dicts.append(msg_dict)
 
 
-async def sync_msgs(client, chat_id, min_id, max_id=0):
+async def fetch_msgs(client, chat_id, min_id, max_id=0):
     '''
     NOTE: min_id and max_id are inclusive
 
-    return the last message id synced
+    return the rows of the next page as (msg_dicts, photo_dicts, document_dicts, last_seen),
+    last_seen is the id of the last item fetched, service messages included,
+    None when there is nothing left between min_id and max_id
     '''
-    logger.info(f'Fetching next {config["tg"]["message_limit"]} messages from {chat_id}/{min_id}')
+    limit = message_limit(client)
+    logger.info(f'Fetching next {limit} messages from {chat_id}/{min_id}')
     min_id = min_id-1
     max_id = 0 if max_id == 0 else max_id+1
 
     msg_dicts = []
     photo_dicts = []
     document_dicts = []
+    last_seen = None
 
     msg_iter = client.iter_messages(
         chat_id,
         reverse=True,
         min_id=min_id,
         max_id=max_id,
-        limit=config['tg']['message_limit'],
+        limit=limit,
     )
     async for msg in msg_iter:
+        last_seen = msg.id
         if type(msg) is Message:
             msg_to_dicts(msg, msg_dicts, photo_dicts, document_dicts)
-    if len(msg_dicts) == 0:
-        return -1
 
+    return msg_dicts, photo_dicts, document_dicts, last_seen
+
+
+def update_chat_state(session, chat_id, last_id=0, inserted=0):
+    stmt = insert(ChatStateEntity).values(
+        chat_id=chat_id,
+        last_id=last_id,
+        message_count=inserted,
+        last_run=datetime.now(timezone.utc).replace(tzinfo=None),
+    )
+    session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=['chat_id'],
+            set_={
+                'last_id': case(
+                    (stmt.excluded.last_id > ChatStateEntity.last_id, stmt.excluded.last_id),
+                    else_=ChatStateEntity.last_id,
+                ),
+                'message_count': ChatStateEntity.message_count + stmt.excluded.message_count,
+                'last_run': stmt.excluded.last_run,
+            }
+        )
+    )
+
+
+def insert_media(session, entity_class, media_dicts, copy=False):
+    '''
+    Insert new media, refreshing the stored location of the ones
+    seen before that still wait for download.
+    '''
+    # ON CONFLICT cannot update the same row twice in one statement,
+    # e.g. a sticker sent twice in a page. Rows go in id order so concurrent
+    # backfill partitions lock shared media in the same order and never deadlock.
+    media_dicts = sorted({media_dict['id']: media_dict for media_dict in media_dicts}.values(), key=lambda d: d['id'])
+    location_columns = ['access_hash', 'file_reference', 'dc_id']
+    if entity_class is PhotoEntity:
+        location_columns += ['thumb_size', 'size']
+    execute_insert(
+        session, entity_class, media_dicts,
+        lambda stmt: stmt.on_conflict_do_update(
+            index_elements=['id'],
+            set_={column: stmt.excluded[column] for column in location_columns},
+            where=(entity_class.saved == False),
+        ),
+        copy,
+    )
+
+
+def write_msgs(msg_dicts, photo_dicts, document_dicts, advance=True, covered_from=None, covered_to=None):
+    '''
+    Insert one page of rows from a single chat, with advance the chat's
+    resume point moves up to the last message of the page. With covered_from
+    the ids from there to covered_to, by default the last message of the
+    page, are recorded as synced.
+
+    `tg.ingest` picks how rows are sent: "insert" statements or "copy".
+    '''
+    copy = config['tg'].get('ingest', 'insert') == 'copy'
     with session_generator() as session:
         if len(photo_dicts) > 0:
-            session.execute(
-                insert(PhotoEntity)
-                .values(photo_dicts)
-                .on_conflict_do_nothing(index_elements=['id'])
-            )
+            insert_media(session, PhotoEntity, photo_dicts, copy)
         if len(document_dicts) > 0:
-            session.execute(
-                insert(DocumentEntity)
-                .values(document_dicts)
-                .on_conflict_do_nothing(index_elements=['id'])
-            )
-        session.execute(
-            insert(MessageEntity)
-            .values(msg_dicts)
-            .on_conflict_do_nothing(index_elements=['id', 'chat_id'])
+            insert_media(session, DocumentEntity, document_dicts, copy)
+        inserted = execute_insert(
+            session, MessageEntity, msg_dicts,
+            lambda stmt: stmt.on_conflict_do_nothing(index_elements=['id', 'chat_id']),
+            copy,
         )
+        covered_to = covered_to or msg_dicts[-1]['id']
+        update_chat_state(
+            session,
+            msg_dicts[0]['chat_id'],
+            last_id=covered_to if advance else 0,
+            inserted=inserted,
+        )
+        if covered_from is not None:
+            add_range(session, msg_dicts[0]['chat_id'], covered_from, covered_to)
+    MESSAGES.labels(msg_dicts[0]['chat_id']).inc(len(msg_dicts))
 
-    return msg_dicts[-1]['id']
 
+async def sync_msgs(client, chat_id, min_id, max_id=0):
+    '''
+    NOTE: min_id and max_id are inclusive
+
+    return the last message id synced
+    '''
+    msg_dicts, photo_dicts, document_dicts, last_seen = await fetch_msgs(client, chat_id, min_id, max_id)
+    if len(msg_dicts) == 0:
+        return -1 if last_seen is None else last_seen
+
+    await run_db(write_msgs, msg_dicts, photo_dicts, document_dicts, covered_to=last_seen)
+
+    return last_seen
 
-async def sync_chat(client, chat_id, min_id=0, max_id=0, resume=True):
-    logger.info(f'Synchronizing {chat_id} from {min_id} to {max_id}')
 
-    last_id = 0
-    if resume:
-        with session_generator() as session:
-            last_processed = (
-                session.query(MessageEntity)
-                .filter(MessageEntity.chat_id == chat_id)
-                .order_by(MessageEntity.id.desc())
-                .limit(1)
-                .one_or_none()
-            )
-        if last_processed:
-            last_id = last_processed.id
-            logger.info(f'Resuming from: {last_id}')
-
-    last_id = max(last_id, min_id-1)
+def record_range(chat_id, start_id, end_id):
+    '''
+    Record [start_id, end_id] as synced, for ids found to hold no messages.
+    '''
+    with session_generator() as session:
+        update_chat_state(session, chat_id)
+        add_range(session, chat_id, start_id, end_id)
 
+
+def write_page(chat_id, page, covered_from, advance=True):
+    '''
+    Write a page from fetch_msgs and record covered_from up to its
+    last item as synced, also when it held only service messages.
+    '''
+    msg_dicts, photo_dicts, document_dicts, last_seen = page
+    if msg_dicts:
+        write_msgs(msg_dicts, photo_dicts, document_dicts, advance, covered_from, last_seen)
+    else:
+        record_range(chat_id, covered_from, last_seen)
+
+
+async def sync_serial(client, chat_id, last_id, max_id):
+    synced_count = 0
     while max_id == 0 or last_id < max_id:
-        synced = await sync_msgs(client, chat_id, last_id+1, max_id)
+        page = await fetch_msgs(client, chat_id, last_id+1, max_id)
+        if page[3] is None:
+            break
+
+        await run_db(write_page, chat_id, page, last_id+1)
+        synced_count += len(page[0])
+        last_id = page[3]
+
+    if max_id and last_id < max_id:
+        await run_db(record_range, chat_id, last_id+1, max_id)
+    return last_id, synced_count
+
+
+async def sync_pipelined(client, chat_id, last_id, max_id, depth):
+    '''
+    Keep fetching pages while earlier ones are being written,
+    at most `depth` fetched pages wait for the writer.
+    '''
+    queue = asyncio.Queue(maxsize=depth)
+
+    async def produce():
+        nonlocal last_id
+        try:
+            while max_id == 0 or last_id < max_id:
+                page = await fetch_msgs(client, chat_id, last_id+1, max_id)
+                if page[3] is None:
+                    break
+                covered_from, last_id = last_id+1, page[3]
+                await queue.put((page, covered_from))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            await queue.put(None)
+            raise
+        await queue.put(None)
+
+    async def consume():
+        synced_count = 0
+        while (item := await queue.get()) is not None:
+            page, covered_from = item
+            await run_db(write_page, chat_id, page, covered_from)
+            synced_count += len(page[0])
+            logger.debug(f'Written {chat_id} up to {page[3]}, {queue.qsize()} pages pending')
+        return synced_count
+
+    producer = asyncio.create_task(produce())
+    try:
+        synced_count = await consume()
+    except BaseException:
+        producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+        raise
+    await producer
+
+    if max_id and last_id < max_id:
+        await run_db(record_range, chat_id, last_id+1, max_id)
+    return last_id, synced_count
+
+
+async def get_top_id(client, chat_id):
+    msgs = await client.get_messages(chat_id, limit=1)
+    return msgs[0].id if msgs else 0
+
+
+def split_partitions(low, high, parts):
+    '''
+    Split [low, high] into at most `parts` ranges, newest first.
+    '''
+    size = -(-(high - low + 1) // parts)
+    return [(start, min(start + size - 1, high)) for start in range(low, high + 1, size)][::-1]
+
+
+async def sync_partition(client, chat_id, start, end):
+    '''
+    Sync [start, end] upward without moving the chat's resume point.
+    '''
+    last_id = start - 1
+    synced_count = 0
+    while last_id < end:
+        page = await fetch_msgs(client, chat_id, last_id+1, end)
+        if page[3] is None:
+            break
+
+        await run_db(write_page, chat_id, page, last_id+1, advance=False)
+        synced_count += len(page[0])
+        last_id = page[3]
+
+    if last_id < end:
+        await run_db(record_range, chat_id, last_id+1, end)
+    return synced_count
+
+
+async def sync_backfill(client, chat_id, low, high, partitions, concurrent, on_partition=None):
+    '''
+    Sync [low, high] as `partitions` id ranges, up to `concurrent` of them
+    at a time and newest first, so the recent history of a new chat is
+    stored before the old. All requests share the client's rate limiter.
+    on_partition(start, end) is called once each partition is written,
+    so its media can be queued without waiting for the whole chat.
+
+    The resume point only moves to high once every partition is done,
+    after a failure the next run only fetches what the ledger lacks.
+    '''
+    pending = split_partitions(low, high, partitions)
+    synced_count = 0
+
+    async def worker():
+        nonlocal synced_count
+        while pending:
+            start, end = pending.pop(0)
+            logger.info(f'Backfilling {chat_id} from {start} to {end}, {len(pending)} partitions left')
+            partition_count = await sync_partition(client, chat_id, start, end)
+            synced_count += partition_count
+            if on_partition:
+                on_partition(start, end)
+
+    tasks = [asyncio.create_task(worker()) for _ in range(min(concurrent, len(pending)))]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+    await run_db(record_run, chat_id, high)
+    return high, synced_count
+
+
+def record_run(chat_id, last_id=0):
+    with session_generator() as session:
+        update_chat_state(session, chat_id, last_id=last_id)
+
+
+async def sync_range(client, chat_id, start, end, new_chat, on_partition=None):
+    '''
+    Sync the gap [start, end], end 0 for up to the newest message.
+
+    return (last_id, synced_count)
+    '''
+    backfill = config['tg'].get('backfill')
+    if backfill and (end or new_chat):
+        # Partition the gap when it spans enough pages, the top of
+        # an open gap is only looked up for chats with nothing synced.
+        partitions = backfill.get('partitions', 8)
+        top_id = end or await get_top_id(client, chat_id)
+        if top_id - start + 1 >= partitions * message_limit(client):
+            return await sync_backfill(client, chat_id, start, top_id, partitions, backfill.get('concurrent', 4), on_partition)
+
+    depth = config['tg'].get('pipeline_depth', 0)
+    if depth > 0:
+        return await sync_pipelined(client, chat_id, start-1, end, depth)
+    return await sync_serial(client, chat_id, start-1, end)
+
+
+async def sync_chat(client, chat_id, min_id=0, max_id=0, resume=True, on_partition=None):
+    '''
+    Fetch the ids of [min_id, max_id] missing from the chat's synced ranges,
+    every id again without resume. max_id 0 for up to the newest message.
+    on_partition is handed to sync_backfill for gaps that are backfilled.
+
+    return the last message id synced
+    '''
+    logger.info(f'Synchronizing {chat_id} from {min_id} to {max_id}')
+    if not isinstance(chat_id, int):
+        chat_id = await client.get_peer_id(chat_id)
+
+    ranges = await run_db(get_ranges, chat_id) if resume else []
+    gaps = uncovered(ranges, max(min_id, 1), max_id)
+    if ranges:
+        logger.info(f'{len(gaps)} gaps left in {format_ranges(ranges)}')
 
-        if synced == -1:
-            logger.info(f'Finished synchronizing {chat_id} from {min_id} to {max_id}')
-            return last_id
+    start_time = time()
+    last_id, synced_count = ranges[-1][1] if ranges else 0, 0
+    for start, end in gaps:
+        last_id, gap_count = await sync_range(client, chat_id, start, end, not ranges, on_partition)
+        synced_count += gap_count
+    elapsed = time() - start_time
+    await run_db(record_run, chat_id)
 
-        last_id = synced
+    logger.info(f'Finished synchronizing {chat_id} from {min_id} to {max_id}: '
+                f'{synced_count} messages in {elapsed:.1f}s ({synced_count / max(elapsed, 1e-6):.1f} msgs/s)')
+    return last_id
 
 
 async def main():
@@ -155,5 +431,4 @@ async def main():
 
 
 if __name__ == '__main__':
-    import asyncio
     asyncio.run(main())
@@ -0,0 +1,62 @@
+import asyncio
+import traceback
+
+from tgsync.config import config
+from tgsync.logger import logger
+
+
+class WarmSenders:
+    '''
+    Keeps a connection to every DC that still has media in the download
+    queue open on each client of the pool.
+
+    Telethon disconnects exported senders of other DCs after a minute
+    without borrows, so a DC coming back later in the queue would have
+    to reconnect. Holding one borrow per client and DC while its media is
+    pending, plus `download.dc_linger` seconds, keeps them connected.
+    '''
+
+    def __init__(self, pool, queue):
+        self.pool = pool
+        self.queue = queue
+        self.linger = config['download'].get('dc_linger', 30)
+        self.held = {}
+
+
+    async def hold(self, client, dc_id):
+        if (client, dc_id) in self.held or dc_id == client.session.dc_id:
+            return
+        self.held[(client, dc_id)] = await client._borrow_exported_sender(dc_id)
+        logger.debug(f'Holding connection to DC{dc_id} for {self.pool.names[client]}')
+
+
+    async def release(self, client, dc_id):
+        sender = self.held.pop((client, dc_id))
+        await client._return_exported_sender(sender)
+        logger.debug(f'Released connection to DC{dc_id} for {self.pool.names[client]}')
+
+
+    async def refresh(self):
+        active = {dc_id for dc_id in self.queue.active_dcs() if dc_id}
+        for client in self.pool.clients:
+            if not (hasattr(client, '_borrow_exported_sender') and client.is_connected()):
+                continue
+            for dc_id in active:
+                await self.hold(client, dc_id)
+        for client, dc_id in list(self.held):
+            if dc_id not in active:
+                await self.release(client, dc_id)
+
+
+    async def run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception:
+                logger.error(f'Failed to warm DC connections: {traceback.format_exc()}')
+            await asyncio.sleep(self.linger)
+
+
+    async def close(self):
+        for client, dc_id in list(self.held):
+            await self.release(client, dc_id)
@@ -0,0 +1,97 @@
+import asyncio
+import traceback
+
+from sqlalchemy import update, case
+
+from tgsync.config import config
+from tgsync.logger import logger
+from tgsync.db.session import session_generator, run_db
+from tgsync.db.entities import PhotoEntity, DocumentEntity
+
+
+def write_saved(batch):
+    with session_generator() as session:
+        for entity_class, digests in batch.items():
+            if not digests:
+                continue
+
+            values = {'saved': True}
+            hashed = {media_id: digest for media_id, digest in digests.items() if digest}
+            if hashed:
+                values['content_hash'] = case(hashed, value=entity_class.id, else_=entity_class.content_hash)
+
+            session.execute(
+                update(entity_class)
+                .where(entity_class.id.in_(list(digests)))
+                .values(**values)
+            )
+
+
+class CompletionSink:
+    '''
+    Collects the ids and content hashes of finished downloads and marks
+    them saved with one UPDATE per media type, every
+    `download.completion_batch` items or `download.completion_interval`
+    milliseconds, whichever comes first.
+
+    close() must be awaited on shutdown to flush what is still buffered.
+    '''
+
+    def __init__(self):
+        self.batch_size = config['download'].get('completion_batch', 256)
+        self.interval = config['download'].get('completion_interval', 1000) / 1000
+        self.pending = {PhotoEntity: {}, DocumentEntity: {}}
+        self.lock = asyncio.Lock()
+        self.task = None
+
+
+    @property
+    def buffered(self):
+        return sum(len(ids) for ids in self.pending.values())
+
+
+    async def add(self, entity_class, media_id, digest=None):
+        self.pending[entity_class][media_id] = digest
+        if self.buffered >= self.batch_size:
+            await self.flush()
+
+
+    async def flush(self):
+        async with self.lock:
+            if self.buffered == 0:
+                return
+
+            batch = {entity_class: dict(digests) for entity_class, digests in self.pending.items()}
+            for digests in self.pending.values():
+                digests.clear()
+
+            logger.debug(f'Marking {sum(len(ids) for ids in batch.values())} media as saved')
+            try:
+                await run_db(write_saved, batch)
+            except BaseException:
+                for entity_class, digests in batch.items():
+                    self.pending[entity_class].update(digests)
+                raise
+
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.error(f'Failed to flush saved media, {self.buffered} buffered: {traceback.format_exc()}')
+
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if self.buffered:
+            logger.info(f'Flushing {self.buffered} buffered saved media')
+        await self.flush()
@@ -0,0 +1,61 @@
+from io import StringIO
+from datetime import datetime, timezone
+
+from sqlalchemy import table, column
+
+
+ESCAPES = str.maketrans({'\\': '\\\\', '\n': '\\n', '\r': '\\r', '\t': '\\t', '\0': ''})
+
+
+def copy_value(value):
+    '''
+    value in the text format of COPY
+    '''
+    if value is None:
+        return '\\N'
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    if isinstance(value, bytes):
+        return '\\\\x' + value.hex()
+    if isinstance(value, datetime):
+        # Columns are timestamp without time zone, store UTC wall-clock like
+        # the INSERT path does instead of letting Postgres drop the offset.
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value.isoformat()
+    if isinstance(value, str):
+        return value.translate(ESCAPES)
+    return str(value)
+
+
+def copy_rows(session, target, rows):
+    '''
+    COPY rows, dicts keyed by the columns of target, into a temporary
+    staging table shaped like target in the session's transaction,
+    Postgres with psycopg2 only.
+
+    Staging tables live as long as the pooled connection and are emptied
+    on commit, so each is created once per connection.
+
+    return the staging table to INSERT ... SELECT from
+    '''
+    names = [c.name for c in target.columns]
+    stage_name = f'stage_{target.name}'
+
+    buffer = StringIO()
+    buffer.writelines('\t'.join(copy_value(row.get(name)) for name in names) + '\n' for row in rows)
+    buffer.seek(0)
+
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.execute(
+            f'CREATE TEMPORARY TABLE IF NOT EXISTS {stage_name} '
+            f'(LIKE {target.name} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS'
+        )
+        cursor.copy_expert(f'COPY {stage_name} ({", ".join(names)}) FROM STDIN', buffer)
+    finally:
+        cursor.close()
+
+    return table(stage_name, *(column(name) for name in names))
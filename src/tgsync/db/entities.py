@@ -1,5 +1,6 @@
 from sqlalchemy.orm import declarative_base
-from sqlalchemy import Column, Boolean, BigInteger, DateTime, String, Text, ForeignKey
+from sqlalchemy import Column, Boolean, BigInteger, Integer, DateTime, String, Text, LargeBinary, ForeignKey, Index
+from sqlalchemy import func, literal_column
 
 Base = declarative_base()
 
@@ -9,6 +10,20 @@ class PhotoEntity(Base):
 
     id      = Column(BigInteger, primary_key=True)
     saved   = Column(Boolean, default=False)
+    # Not the sha256 of the file: sha256 over the sha256 of every 1 MiB
+    # block, see core/content_hash.py, so ranges can be hashed as they stream in.
+    content_hash = Column(String(64))
+
+    access_hash    = Column(BigInteger)
+    file_reference = Column(LargeBinary)
+    dc_id          = Column(Integer)
+    thumb_size     = Column(String(8))
+    size           = Column(BigInteger)
+
+    __table_args__ = (
+        Index('ix_photo_unsaved', id, postgresql_where=(saved == False), sqlite_where=(saved == False)),
+        Index('ix_photo_content_hash', content_hash),
+    )
 
 
 class DocumentEntity(Base):
@@ -19,6 +34,16 @@ class DocumentEntity(Base):
     size    = Column(BigInteger)
     name    = Column(String(255))
     saved   = Column(Boolean, default=False)
+    content_hash = Column(String(64)) # Block hash, see PhotoEntity
+
+    access_hash    = Column(BigInteger)
+    file_reference = Column(LargeBinary)
+    dc_id          = Column(Integer)
+
+    __table_args__ = (
+        Index('ix_document_unsaved', id, postgresql_where=(saved == False), sqlite_where=(saved == False)),
+        Index('ix_document_content_hash', content_hash),
+    )
 
 
 class MessageEntity(Base):
@@ -43,6 +68,48 @@ class MessageEntity(Base):
     photo_id    = Column(BigInteger, ForeignKey('photo.id'))
     document_id = Column(BigInteger, ForeignKey('document.id'))
     linked      = Column(Boolean, default=False)
+    deleted     = Column(Boolean, default=False)
+
+    __table_args__ = (
+        Index('ix_message_chat_id_id', chat_id, id),
+        Index('ix_message_photo_id', photo_id),
+        Index('ix_message_document_id', document_id),
+        Index('ix_message_unlinked', chat_id, id, postgresql_where=(linked == False), sqlite_where=(linked == False)),
+        # Order of search results, walked backwards so a page of a common term
+        # stops after `limit` matches instead of sorting every match.
+        Index('ix_message_date_chat_id_id', date, chat_id, id),
+    )
+
+
+TS_CONFIG = 'simple'
+
+def message_tsvector():
+    '''
+    Words of MessageEntity.message for full-text search, must stay
+    identical to the expression of ix_message_fts for the index to be used.
+    '''
+    return func.to_tsvector(literal_column(f"'{TS_CONFIG}'::regconfig"), MessageEntity.message)
+
+
+class ChatStateEntity(Base):
+    __tablename__ = 'chat_state'
+
+    chat_id       = Column(BigInteger, primary_key=True)
+    last_id       = Column(BigInteger, default=0)
+    message_count = Column(BigInteger, default=0)
+    last_run      = Column(DateTime)
+
+
+class SyncedRangeEntity(Base):
+    '''
+    Message ids of a chat known to be synced, start_id and end_id
+    inclusive. Ranges of a chat never overlap or touch, see add_range.
+    '''
+    __tablename__ = 'synced_range'
+
+    chat_id  = Column(BigInteger, primary_key=True)
+    start_id = Column(BigInteger, primary_key=True)
+    end_id   = Column(BigInteger)
 
 
 class FileCodeEntity(Base):
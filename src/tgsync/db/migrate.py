@@ -0,0 +1,133 @@
+from sqlalchemy import inspect, literal, text, select, func
+
+from tgsync.logger import logger
+from tgsync.db.entities import Base, MessageEntity, ChatStateEntity, SyncedRangeEntity, message_tsvector
+
+
+FTS_INDEX = 'ix_message_fts'
+RENAMED_COLUMNS = {
+    # table: [(old name, new name, index on the old name)]
+    'photo': [('sha256', 'content_hash', 'ix_photo_sha256')],
+    'document': [('sha256', 'content_hash', 'ix_document_sha256')],
+}
+
+
+def rename_columns(engine):
+    '''
+    Keep the values of renamed columns, add_missing_columns would only add them empty.
+    Indexes on the old name are dropped and created again by add_missing_indexes.
+    '''
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table, renames in RENAMED_COLUMNS.items():
+            if not inspector.has_table(table):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table)}
+            for old, new, index in renames:
+                if old not in existing or new in existing:
+                    continue
+                logger.info(f'Migrating: renaming {table}.{old} to {new}')
+                conn.execute(text(f'DROP INDEX IF EXISTS {index}'))
+                conn.execute(text(f'ALTER TABLE {table} RENAME COLUMN {old} TO {new}'))
+
+
+def add_missing_columns(engine):
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+
+                ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=engine.dialect)}'
+                if column.default is not None and column.default.is_scalar:
+                    default = literal(column.default.arg).compile(dialect=engine.dialect, compile_kwargs={'literal_binds': True})
+                    ddl += f' DEFAULT {default}'
+
+                logger.info(f'Migrating: {ddl}')
+                conn.execute(text(ddl))
+
+
+def add_missing_indexes(engine):
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    logger.info(f'Migrating: creating index {index.name} on {table.name}, this may take a while')
+                    index.create(conn)
+
+
+def add_fts_index(engine):
+    '''
+    GIN index for full-text search of messages, Postgres only. Postgres
+    keeps it up to date on every insert and update of a message, so rows
+    written by sync_msgs are searchable as soon as they are committed.
+    '''
+    if engine.dialect.name != 'postgresql':
+        return
+    if FTS_INDEX in {index['name'] for index in inspect(engine).get_indexes(MessageEntity.__tablename__)}:
+        return
+
+    expression = message_tsvector().compile(dialect=engine.dialect, compile_kwargs={'literal_binds': True})
+    logger.info(f'Migrating: creating index {FTS_INDEX} on {MessageEntity.__tablename__}, this may take a while')
+    with engine.begin() as conn:
+        conn.execute(text(f'CREATE INDEX {FTS_INDEX} ON {MessageEntity.__tablename__} USING gin ({expression})'))
+
+
+def seed_chat_state(engine):
+    logger.info('Migrating: deriving chat_state from existing messages')
+    with engine.begin() as conn:
+        conn.execute(
+            ChatStateEntity.__table__.insert().from_select(
+                ['chat_id', 'last_id', 'message_count'],
+                select(
+                    MessageEntity.chat_id,
+                    func.max(MessageEntity.id),
+                    func.count(),
+                ).group_by(MessageEntity.chat_id)
+            )
+        )
+
+
+def seed_synced_ranges(engine):
+    '''
+    Before the ledger only the resume point was kept, everything from the
+    first stored message up to it was synced in order.
+    '''
+    logger.info('Migrating: deriving synced_range from existing messages')
+    first_id = func.min(MessageEntity.id)
+    with engine.begin() as conn:
+        conn.execute(
+            SyncedRangeEntity.__table__.insert().from_select(
+                ['chat_id', 'start_id', 'end_id'],
+                select(MessageEntity.chat_id, first_id, ChatStateEntity.last_id)
+                .join(ChatStateEntity, MessageEntity.chat_id == ChatStateEntity.chat_id)
+                .group_by(MessageEntity.chat_id, ChatStateEntity.last_id)
+                .having(first_id <= ChatStateEntity.last_id)
+            )
+        )
+
+
+def migrate(engine):
+    '''
+    Bring the database up to date with entities.py,
+    create_all alone only creates missing tables.
+    '''
+    inspector = inspect(engine)
+    had_messages = inspector.has_table(MessageEntity.__tablename__)
+    had_chat_state = inspector.has_table(ChatStateEntity.__tablename__)
+    had_synced_ranges = inspector.has_table(SyncedRangeEntity.__tablename__)
+
+    rename_columns(engine)
+    Base.metadata.create_all(engine)
+    add_missing_columns(engine)
+    add_missing_indexes(engine)
+    add_fts_index(engine)
+
+    if had_messages and not had_chat_state:
+        seed_chat_state(engine)
+    if had_messages and not had_synced_ranges:
+        seed_synced_ranges(engine)
@@ -1,19 +1,44 @@
+import asyncio
+from functools import partial
 from contextlib import contextmanager
-from sqlalchemy import create_engine
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker
 
 from tgsync.config import config
 from tgsync.logger import logger
+from tgsync.metrics import instrument_engine
+
 
+# SQLAlchemy 1.4 gives SQLite files a NullPool, which takes no pool sizes.
+pool_args = {}
+if make_url(config['db']['url']).get_backend_name() != 'sqlite':
+    pool_args = {'pool_size': 20, 'max_overflow': -1}
 
 engine = create_engine(
     url=config['db']['url'],
     echo=False,
     pool_pre_ping=True,
-    pool_size=20,
-    max_overflow=-1,
     pool_recycle=3600,
+    **pool_args,
 )
+instrument_engine(engine)
+
+
+if engine.dialect.name == 'sqlite':
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        '''
+        WAL lets readers run alongside the writer, with synchronous=NORMAL
+        a commit only appends to the log instead of waiting for an fsync.
+        '''
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute(f'PRAGMA busy_timeout={config["db"].get("busy_timeout", 30000)}')
+        cursor.close()
 
 
 Session = sessionmaker(bind=engine, expire_on_commit=False)
@@ -29,3 +54,18 @@ def session_generator():
         raise
     finally:
         session.close()
+
+
+# SQLite takes one writer at a time, more threads would only wait on its lock.
+executor = ThreadPoolExecutor(
+    max_workers=1 if engine.dialect.name == 'sqlite' else config['db'].get('workers', 8),
+    thread_name_prefix='db',
+)
+
+async def run_db(fn, *args, **kwargs):
+    '''
+    Run a blocking database function on the DB executor,
+    coroutines must never touch session_generator directly.
+    '''
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, partial(fn, *args, **kwargs))
@@ -0,0 +1,38 @@
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from tgsync.db.session import engine
+from tgsync.db.copy import copy_rows
+
+
+def insert(entity_class):
+    '''
+    INSERT of the configured database, with on_conflict_do_nothing and
+    on_conflict_do_update available on both Postgres and SQLite.
+    '''
+    if engine.dialect.name == 'sqlite':
+        return sqlite.insert(entity_class)
+    return postgresql.insert(entity_class)
+
+
+def execute_insert(session, entity_class, rows, on_conflict, copy=False):
+    '''
+    INSERT rows into entity_class, with on_conflict(stmt) adding the
+    ON CONFLICT clause.
+
+    Postgres gets a single multi-row VALUES to save round trips or, with
+    copy, an INSERT ... SELECT from a staging table filled through COPY,
+    which skips compiling and parsing one bind parameter per column and row.
+    SQLite, in process, gets one cached statement executed for every row.
+
+    return the number of rows inserted or updated
+    '''
+    if copy:
+        stage = copy_rows(session, entity_class.__table__, rows)
+        stmt = insert(entity_class).from_select(list(stage.c.keys()), select(stage))
+        result = session.execute(on_conflict(stmt))
+    elif engine.dialect.name == 'sqlite':
+        result = session.connection().execute(on_conflict(insert(entity_class.__table__)), rows)
+    else:
+        result = session.execute(on_conflict(insert(entity_class).values(rows)))
+    return max(result.rowcount, 0)
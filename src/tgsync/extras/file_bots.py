@@ -2,13 +2,14 @@ import re
 import asyncio
 from abc import ABC, abstractmethod
 
-from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy import select
 
 from tgsync.logger import logger
 from tgsync.core.get_client import get_client
 from tgsync.core.sync_chat import sync_chat
 
-from tgsync.db.session import session_generator
+from tgsync.db.session import session_generator, run_db
+from tgsync.db.upsert import insert
 from tgsync.db.entities import FileCodeEntity
 
 
@@ -34,7 +35,35 @@ class FileBotHandler(ABC):
         return None
 
 
-    def search_code(self, string):
+    @staticmethod
+    def insert_codes(code_dicts):
+        with session_generator() as session:
+            session.execute(
+                insert(FileCodeEntity)
+                .values(code_dicts)
+                .on_conflict_do_nothing(index_elements=['code'])
+            )
+
+
+    @staticmethod
+    def update_code_range(code, start_id, end_id):
+        with session_generator() as session:
+            code_entity = session.get(FileCodeEntity, code)
+            code_entity.start_id = start_id
+            code_entity.end_id = end_id
+
+
+    def get_pending_codes(self):
+        with session_generator() as session:
+            code = session.execute(
+                select(FileCodeEntity.code)
+                .where(FileCodeEntity.bot_username == self.username)
+                .where(FileCodeEntity.start_id == None)
+            ).scalars().all()
+        return code
+
+
+    async def search_code(self, string):
         code = []
         for pattern in self.patterns:
             code.extend(re.findall(pattern, string))
@@ -43,29 +72,14 @@ class FileBotHandler(ABC):
         if len(code_dicts) == 0:
             logger.warning(f'No code found in {string} for @{self.username}')
             return
-        with session_generator() as session:
-            session.execute(
-                insert(FileCodeEntity)
-                .values(code_dicts)
-                .on_conflict_do_nothing(index_elements=['code'])
-            )
+        await run_db(self.insert_codes, code_dicts)
 
 
     async def sync_retrived(self, code):
         logger.info(f'Starting sync response from {self.username}/{self.start_id}')
         end_id = await sync_chat(self.client, self.username, self.start_id, resume=False)
 
-        file_code_entity = FileCodeEntity(
-            code = code,
-            bot_username = self.username,
-            start_id = self.start_id,
-            end_id = end_id
-        )
-
-        with session_generator() as session:
-            code_entity = session.get(FileCodeEntity, code)
-            code_entity.start_id = self.start_id
-            code_entity.end_id = end_id
+        await run_db(self.update_code_range, code, self.start_id, end_id)
 
 
     @abstractmethod
@@ -74,15 +88,8 @@ class FileBotHandler(ABC):
 
 
     async def retrive_files(self):
-        with session_generator() as session:
-            code = (
-                session.query(FileCodeEntity)
-                .filter(FileCodeEntity.bot_username == self.username)
-                .filter(FileCodeEntity.start_id == None)
-            ).all()
-
-        for c in code:
-            await self.process_code(c.code)
+        for code in await run_db(self.get_pending_codes):
+            await self.process_code(code)
 
 
 class ShowFilesBotHandler(FileBotHandler):
@@ -152,7 +159,7 @@ async def main():
     with open(appdata / 'code.txt', 'r') as f:
         line = f.read().splitlines()
     for l in line:
-        bot.search_code(l)
+        await bot.search_code(l)
 
     await bot.retrive_files()
 
@@ -1,67 +1,81 @@
 import os
+import signal
 import asyncio
 import argparse
 
 from tgsync.config import appdata, config
 from tgsync.logger import logger
-from tgsync.core.get_client import get_client
-from tgsync.core.list_chats import list_chats
-from tgsync.core.sync_chat import sync_chat
-from tgsync.core.save_media import save_all
-from tgsync.core.link_media import link_media
+from tgsync.core.client_pool import ClientPool, session_names
+from tgsync.core.scheduler import Scheduler
+from tgsync.core.live import LiveSync
+from tgsync.core import search, export, ledger
 
-from tgsync.db.session import engine
-from tgsync.db.entities import Base
+from tgsync.metrics import start_server
+from tgsync.db.session import engine, run_db
+from tgsync.db.migrate import migrate
 
 
-async def process(client, chat_id):
-    logger.info(f'Processing chat {chat_id}')
+async def main(args):
+    if args.ingest:
+        config['tg']['ingest'] = args.ingest
+    if config['tg'].get('ingest') == 'copy' and engine.dialect.name != 'postgresql':
+        logger.warning('COPY ingest needs Postgres, falling back to insert')
+        config['tg']['ingest'] = 'insert'
+    await run_db(migrate, engine)
 
-    min_id, max_id = 0, 0
-    if 'range' in config['tg']['chats'][chat_id]:
-        min_id, max_id = config['tg']['chats'][chat_id]['range']
+    setup = args.setup or not all(os.path.exists(appdata / session) for session in session_names())
+    if setup:
+        logger.warning('No session file found. Please run the container in interactive mode to login.')
 
-    logger.info('Syncing messages...')
-    await sync_chat(client, int(chat_id), min_id, max_id)
+    pool = await ClientPool.create()
 
-    if (not 'media' in config['tg']['chats'][chat_id]) or (config['tg']['chats'][chat_id]['media']):
-        logger.info(f'Saving media...')
-        await save_all(client, int(chat_id), True)
-        await save_all(client, int(chat_id), False)
+    if setup:
+        logger.info('You can now restart the container in detached mode.')
+        return
 
-    logger.info('Linking media to chat dir...')
-    link_media()
+    await pool.load_chats()
+    await start_server()
 
-    logger.info(f'Chat {chat_id} completed.')
+    # docker stop sends SIGTERM, cancel like on Ctrl+C so the finally
+    # below flushes the saved flags still buffered in the completion sink.
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
 
+    scheduler = Scheduler(pool)
+    try:
+        if config.get('live', {}).get('enabled'):
+            await LiveSync(pool, scheduler).run()
 
-async def main():
-    Base.metadata.create_all(engine)
+        while True:
+            await scheduler.run()
 
+            logger.info('All chats completed.')
+            logger.info('Waiting for 300 seconds before the next run...')
+            await asyncio.sleep(300)
+    except asyncio.CancelledError:
+        logger.info('Stopping...')
+    finally:
+        await scheduler.close()
+
+
+def cli():
     parser = argparse.ArgumentParser(description='Telegram Sync Tool')
     parser.add_argument('-s', '--setup', action='store_true', help='Run setup')
+    parser.add_argument('--ingest', choices=['insert', 'copy'], help='Override tg.ingest for this run')
+    subparsers = parser.add_subparsers(dest='command')
+    search.add_parser(subparsers)
+    export.add_parser(subparsers)
+    ledger.add_parser(subparsers)
     args = parser.parse_args()
 
-    setup = not os.path.exists(appdata / config['tg']['session']) or args.setup
-    if setup:
-        logger.warning('No session file found. Please run the container in interactive mode to login.')
-
-    client = await get_client()
-
-    if setup:
-        logger.info('You can now restart the container in detached mode.')
-        return
-
-    await list_chats(client)
-
-    while True:
-        for chat_id in config['tg']['chats']:
-            await process(client, chat_id)
-
-        logger.info('All chats completed.')
-        logger.info('Waiting for 300 seconds before the next run...')
-        await asyncio.sleep(300)
+    if args.command == 'search':
+        search.main(args)
+    elif args.command == 'export':
+        export.main(args)
+    elif args.command == 'coverage':
+        ledger.main(args)
+    else:
+        asyncio.run(main(args))
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    cli()
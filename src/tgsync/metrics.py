@@ -0,0 +1,232 @@
+import time
+import asyncio
+import threading
+from bisect import bisect_left
+from abc import ABC, abstractmethod
+
+from sqlalchemy import event
+
+from tgsync.config import config
+from tgsync.logger import logger
+
+
+registry = []
+
+
+class CounterValue:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class GaugeValue(CounterValue):
+    function = None
+
+    def set(self, value):
+        self.value = value
+
+
+    def set_function(self, function):
+        '''
+        Read the value from function at scrape time instead.
+        '''
+        self.function = function
+
+
+    def samples(self, name, labels):
+        yield name, labels, self.function() if self.function else self.value
+
+
+class HistogramValue:
+    def __init__(self, buckets):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + [float('inf')], self.counts):
+            cumulative += count
+            yield f'{name}_bucket', labels + [('le', format_value(bound))], cumulative
+        yield f'{name}_sum', labels, self.sum
+        yield f'{name}_count', labels, cumulative
+
+
+class Metric(ABC):
+    '''
+    A named family of values, one per combination of label values.
+
+    Keep the child returned by labels() around on hot paths,
+    inc() and observe() on it only take an uncontended lock.
+    '''
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.children = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+
+    @abstractmethod
+    def make_child(self):
+        pass
+
+
+    def labels(self, *values):
+        key = tuple(str(v) for v in values)
+        child = self.children.get(key)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(key, self.make_child())
+        return child
+
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for key, child in list(self.children.items()):
+            for name, labels, value in child.samples(self.name, list(zip(self.labelnames, key))):
+                lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def make_child(self):
+        return CounterValue()
+
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def make_child(self):
+        return GaugeValue()
+
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+    def set_function(self, function):
+        self.labels().set_function(function)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=(.001, .005, .01, .05, .1, .5, 1, 5, 10)):
+        self.buckets = list(buckets)
+        super().__init__(name, documentation, labelnames)
+
+
+    def make_child(self):
+        return HistogramValue(self.buckets)
+
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, v in labels)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    return '\n'.join(metric.render() for metric in registry) + '\n'
+
+
+DOWNLOAD_BYTES = Counter('tgsync_download_bytes_total', 'Bytes downloaded by each worker', ['worker'])
+DC_BYTES = Counter('tgsync_dc_download_bytes_total', 'Bytes downloaded from each data center', ['dc'])
+DOWNLOADS = Counter('tgsync_downloads_total', 'Finished downloads', ['type'])
+DOWNLOAD_ERRORS = Counter('tgsync_download_errors_total', 'Failed downloads', ['type'])
+CONCURRENCY = Gauge('tgsync_download_concurrency', 'Downloads allowed to run at once')
+QUEUE_DEPTH = Gauge('tgsync_download_queue_depth', 'Media waiting for a download worker')
+MESSAGES = Counter('tgsync_messages_total', 'Messages written to the database', ['chat'])
+LINKS = Counter('tgsync_links_total', 'Media linked into chat directories')
+DB_LATENCY = Histogram('tgsync_db_statement_seconds', 'Database statement latency', ['statement'])
+FLOOD_WAITS = Counter('tgsync_flood_waits_total', 'Flood waits imposed by Telegram', ['request'])
+FLOOD_WAIT_SECONDS = Counter('tgsync_flood_wait_seconds_total', 'Length of flood waits imposed by Telegram', ['request'])
+RATE_LIMIT_SECONDS = Counter('tgsync_rate_limit_seconds_total', 'Time requests were held back by the rate limiter', ['method'])
+MESSAGE_LIMIT = Gauge('tgsync_message_limit', 'Messages fetched per history page')
+CLIENT_HEALTHY = Gauge('tgsync_client_healthy', 'Whether a pooled client is connected and not flood waited', ['session'])
+TIMEOUTS = Counter('tgsync_timeouts_total', 'Requests that timed out', ['operation'])
+
+
+def instrument_engine(engine):
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info['query_start'] = time.perf_counter()
+
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info.pop('query_start', None)
+        if start is not None:
+            DB_LATENCY.labels(statement.split(None, 1)[0].lower()).observe(time.perf_counter() - start)
+
+
+async def handle_scrape(reader, writer):
+    try:
+        await reader.readuntil(b'\r\n\r\n')
+        body = render().encode()
+        writer.write(
+            b'HTTP/1.1 200 OK\r\n'
+            b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+            + f'Content-Length: {len(body)}\r\n'.encode()
+            + b'Connection: close\r\n\r\n'
+            + body
+        )
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_server():
+    '''
+    Serve every metric in the Prometheus text format on `metrics.host`:`metrics.port`,
+    does nothing when `metrics.port` is not configured.
+    '''
+    metrics_config = config.get('metrics', {})
+    if not metrics_config.get('port'):
+        return None
+
+    host = metrics_config.get('host', '127.0.0.1')
+    server = await asyncio.start_server(handle_scrape, host, metrics_config['port'])
+    logger.info(f'Serving metrics on http://{host}:{metrics_config["port"]}/metrics')
+    return server